@@ -1,5 +1,5 @@
 from flask import Flask
-from . import db, auth, list, item
+from . import db, auth, list, item, search, backup, purge, tiering, feed, reshard, stats, compress, ops
 
 
 def create_app(test_config=None):
@@ -23,9 +23,21 @@ def create_app(test_config=None):
         return 'Notive API is up and running!'
 
     db.init_app(app)
+    purge.init_app(app)
+    tiering.init_app(app)
+    reshard.init_app(app)
+    stats.init_app(app)
+    compress.init_app(app)
+    ops.init_app(app)
     app.register_blueprint(auth.bp)
     app.register_blueprint(list.bp)
     app.register_blueprint(item.bp)
+    app.register_blueprint(search.bp)
+    app.register_blueprint(backup.bp)
+    app.register_blueprint(purge.bp)
+    app.register_blueprint(feed.bp)
+    app.register_blueprint(stats.bp)
+    app.register_blueprint(ops.bp)
 
     app.url_map.strict_slashes = False
     return app
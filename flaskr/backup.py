@@ -0,0 +1,219 @@
+import json
+
+from flask import (
+    Blueprint, g, request, jsonify, make_response, Response, stream_with_context
+)
+from sqlalchemy import Table, select
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.sql import and_
+from .util import validate_auth_key
+from .db import get_db, abort_if_fenced
+from .auth import login_required
+from . import feed, stats, tiering
+
+bp = Blueprint('backup', __name__)
+
+# Number of rows written per transaction (items with one multi-row INSERT).
+# Every batch is committed on its own, so an import never holds locks for the
+# whole upload.
+IMPORT_BATCH_SIZE = 500
+
+# An export ends with an {"type": "end", "lists": n, "items": m} record,
+# written after its last row only, so that a truncated export can be told
+# from a complete one. /import stops reading at that record.
+LIST_FIELDS = ['id', 'name', 'is_done', 'is_muted', 'is_archived', 'created_at', 'finished_at']
+ITEM_FIELDS = ['id', 'list_id', 'name', 'is_done', 'created_at', 'finished_at', 'distance', 'frequency']
+
+
+def to_line(kind, row, fields):
+    record = {'type': kind}
+    for field in fields:
+        record[field] = row[field]
+    return json.dumps(record) + '\n'
+
+
+@bp.route('/export', methods=['GET'], strict_slashes=False)
+@login_required
+def export():
+    if not validate_auth_key(request):
+        return Response(status=401)
+    else:
+        user_id = g.user['id']
+
+        def generate():
+            db = get_db(user_id)
+            con, engine, metadata = db['con'], db['engine'], db['metadata']
+            list_table, item_table, list_archive, item_archive = tiering.get_tables(metadata)
+            # Server-side cursors: rows are fetched from MySQL while they are
+            # written out instead of being buffered in the worker first.
+            streaming = con.execution_options(stream_results=True)
+            counts = {'lists': 0, 'items': 0}
+            try:
+                # Lists are written before items so that an import always knows
+                # the new id of a list before it meets the list's items.
+                lists = streaming.execute(select([list_table])
+                                          .where(and_(list_table.c.user_id == user_id,
+                                                      list_table.c.deleted_at.is_(None)))
+                                          .order_by(list_table.c.id))
+                for l in lists:
+                    counts['lists'] += 1
+                    yield to_line('list', l, LIST_FIELDS)
+                lists = streaming.execute(select([list_archive]).where(list_archive.c.user_id == user_id)
+                                          .order_by(list_archive.c.id))
+                for l in lists:
+                    counts['lists'] += 1
+                    yield to_line('list', l, LIST_FIELDS)
+
+                # Both tiers are exported: items of hot lists from Item and
+                # ItemArchive, items of cold lists from ItemArchive.
+                for items_source, lists_source in tiering.get_item_sources(metadata):
+                    condition = lists_source.c.user_id == user_id
+                    if lists_source is list_table:
+                        condition = and_(condition, list_table.c.deleted_at.is_(None))
+                    items = streaming.execute(select([items_source])
+                                              .select_from(items_source.join(lists_source,
+                                                                             lists_source.c.id == items_source.c.list_id))
+                                              .where(condition)
+                                              .order_by(items_source.c.list_id, items_source.c.id))
+                    for i in items:
+                        counts['items'] += 1
+                        yield to_line('item', i, ITEM_FIELDS)
+            except SQLAlchemyError as e:
+                # The status line is already sent, the client notices the
+                # truncated export by the missing end record.
+                print("DB ERROR: " + str(e.__dict__['orig']))
+                return
+            yield to_line('end', counts, ['lists', 'items'])
+
+        response = Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+        response.headers['Content-Disposition'] = 'attachment; filename=notive-export.ndjson'
+        return response
+
+
+def insert_lists(con, list_table, user_id, rows, list_ids):
+    # Lists are inserted one by one so that every new id is read from its own
+    # INSERT: ids read back by range could include a list created meanwhile
+    # by another device of the user. The batch still shares one transaction.
+    with con.begin():
+        for row in rows:
+            res = con.execute(list_table.insert(),
+                              name=row['name'],
+                              user_id=user_id,
+                              is_done=row.get('is_done') or 0,
+                              is_muted=row.get('is_muted') or 0,
+                              is_archived=row.get('is_archived') or 0,
+                              created_at=row['created_at'],
+                              finished_at=row.get('finished_at'))
+            list_ids[row['id']] = res.lastrowid
+        abort_if_fenced(con, list_table.metadata, user_id)
+
+
+def insert_items(con, item_table, user_id, rows, list_ids):
+    values = []
+    for row in rows:
+        values.append({'name': row['name'],
+                       'list_id': list_ids[row['list_id']],
+                       'is_done': row.get('is_done') or 0,
+                       'created_at': row['created_at'],
+                       'finished_at': row.get('finished_at'),
+                       'distance': row.get('distance') or 5000,
+                       'frequency': row.get('frequency') or 60})
+    with con.begin():
+        con.execute(item_table.insert().values(values))
+        stats.items_added(con, [dict(v, user_id=user_id) for v in values])
+        abort_if_fenced(con, item_table.metadata, user_id)
+
+
+def is_valid_id(value):
+    # Old ids are only used as keys of the id mapping.
+    return isinstance(value, (int, str)) and not isinstance(value, bool)
+
+
+def is_valid_record(row):
+    if isinstance(row, dict) and row.get('type') == 'end':
+        return True
+    if not isinstance(row, dict) or not row.get('name') or not isinstance(row.get('created_at'), int):
+        return False
+    if row.get('type') == 'list':
+        return is_valid_id(row.get('id'))
+    elif row.get('type') == 'item':
+        return is_valid_id(row.get('list_id'))
+    return False
+
+
+@bp.route('/import', methods=['POST'], strict_slashes=False)
+@login_required
+def import_():
+    if not validate_auth_key(request):
+        return Response(status=401)
+    else:
+        user_id = g.user['id']
+        counts = {'lists': 0, 'items': 0}
+        # Only the old -> new list id mapping grows with the upload, records
+        # are parsed line by line and written in batches.
+        list_ids = {}
+        pending_lists = []
+        pending_items = []
+        try:
+            db = get_db(user_id)
+            con, engine, metadata = db['con'], db['engine'], db['metadata']
+            list_table = Table('List', metadata, autoload=True)
+            item_table = Table('Item', metadata, autoload=True)
+
+            for line_no, line in enumerate(request.stream, 1):
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    row = json.loads(line)
+                except ValueError:
+                    row = None
+
+                if not is_valid_record(row):
+                    msg = {"message": "Invalid record on line " + str(line_no) + ".",
+                           "data": counts}
+                    return make_response(jsonify(msg), 400)
+
+                if row['type'] == 'end':
+                    break
+                elif row['type'] == 'list':
+                    pending_lists.append(row)
+                    if len(pending_lists) >= IMPORT_BATCH_SIZE:
+                        insert_lists(con, list_table, user_id, pending_lists, list_ids)
+                        counts['lists'] += len(pending_lists)
+                        pending_lists = []
+                else:
+                    if pending_lists:
+                        insert_lists(con, list_table, user_id, pending_lists, list_ids)
+                        counts['lists'] += len(pending_lists)
+                        pending_lists = []
+                    if row['list_id'] not in list_ids:
+                        msg = {"message": "Item on line " + str(line_no) + " belongs to an unknown list.",
+                               "data": counts}
+                        return make_response(jsonify(msg), 400)
+                    pending_items.append(row)
+                    if len(pending_items) >= IMPORT_BATCH_SIZE:
+                        insert_items(con, item_table, user_id, pending_items, list_ids)
+                        counts['items'] += len(pending_items)
+                        pending_items = []
+
+            if pending_lists:
+                insert_lists(con, list_table, user_id, pending_lists, list_ids)
+                counts['lists'] += len(pending_lists)
+            if pending_items:
+                insert_items(con, item_table, user_id, pending_items, list_ids)
+                counts['items'] += len(pending_items)
+        except SQLAlchemyError as e:
+            error = e.__dict__['orig']
+            print("DB ERROR: " + str(error))
+            msg = {"message": "A server error has been occurred. "
+                              "Please try again later and contact us if the error persists. (Error code: "
+                              + str(error.args[0]) + ")",
+                   "data": str(error)}
+            return make_response(jsonify(msg), 500)
+
+        # Imported rows are announced as a whole, devices resync their lists.
+        feed.publish(user_id, 'account.imported', counts)
+        msg = {"message": "Import is completed successfully!",
+               "data": counts}
+        return make_response(jsonify(msg), 200)
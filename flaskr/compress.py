@@ -0,0 +1,141 @@
+import hashlib
+import json
+import threading
+import time
+import zlib
+from collections import OrderedDict
+
+import click
+from flask import current_app, request
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# JSON responses larger than COMPRESS_MIN_SIZE bytes are compressed with the
+# best encoding the client accepts. Levels favour latency over ratio: past
+# them the CPU time grows much faster than the bytes saved
+# (see 'flask bench-compression').
+COMPRESS_MIN_SIZE = 1024  # bytes
+COMPRESS_GZIP_LEVEL = 5
+COMPRESS_BROTLI_QUALITY = 4
+COMPRESS_CACHE_SIZE = 256  # compressed bodies kept in memory
+COMPRESS_MIMETYPES = ['application/json']
+
+# Compressed GET bodies keyed by (ETag, encoding). The ETag is a digest of the
+# uncompressed body, so an identical response is compressed only once.
+_cache = OrderedDict()
+_cache_lock = threading.Lock()
+
+
+def get_encodings():
+    return ['br', 'gzip'] if brotli is not None else ['gzip']
+
+
+def compress(data, encoding, level):
+    if encoding == 'br':
+        return brotli.compress(data, quality=level)
+    # wbits=31 writes a gzip container; unlike gzip.compress() its header has
+    # no timestamp, so equal bodies give equal bytes.
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+    return compressor.compress(data) + compressor.flush()
+
+
+def get_level(encoding):
+    if encoding == 'br':
+        return current_app.config.get('COMPRESS_BROTLI_QUALITY', COMPRESS_BROTLI_QUALITY)
+    return current_app.config.get('COMPRESS_GZIP_LEVEL', COMPRESS_GZIP_LEVEL)
+
+
+def get_cached(key):
+    with _cache_lock:
+        data = _cache.get(key)
+        if data is not None:
+            _cache.move_to_end(key)
+        return data
+
+
+def set_cached(key, data):
+    with _cache_lock:
+        _cache[key] = data
+        _cache.move_to_end(key)
+        while len(_cache) > current_app.config.get('COMPRESS_CACHE_SIZE', COMPRESS_CACHE_SIZE):
+            _cache.popitem(last=False)
+
+
+def compress_response(response):
+    if response.is_streamed or response.direct_passthrough \
+            or not 200 <= response.status_code < 300 \
+            or 'Content-Encoding' in response.headers \
+            or response.mimetype not in current_app.config.get('COMPRESS_MIMETYPES', COMPRESS_MIMETYPES):
+        return response
+
+    response.vary.add('Accept-Encoding')
+    data = response.get_data()
+    if len(data) < current_app.config.get('COMPRESS_MIN_SIZE', COMPRESS_MIN_SIZE):
+        return response
+    encoding = request.accept_encodings.best_match(get_encodings())
+    if encoding is None:
+        return response
+    level = get_level(encoding)
+
+    if request.method != 'GET':
+        compressed = compress(data, encoding, level)
+    else:
+        etag, weak = response.get_etag()
+        if etag is None:
+            etag = hashlib.md5(data).hexdigest()
+        # Each encoding is a representation of its own with its own ETag.
+        response.set_etag(etag + '-' + encoding)
+        response.make_conditional(request)
+        if response.status_code == 304:
+            return response
+
+        key = (etag, encoding, level)
+        compressed = get_cached(key)
+        if compressed is None:
+            compressed = compress(data, encoding, level)
+            set_cached(key, compressed)
+
+    response.set_data(compressed)
+    response.headers['Content-Encoding'] = encoding
+    return response
+
+
+def make_payload(items):
+    # Shaped like GET /item: items grouped by list.
+    payload = {}
+    for i in range(items):
+        list_id = i // 20
+        payload.setdefault(list_id, []).append({'id': i, 'name': 'Item number ' + str(i), 'list_id': list_id,
+                                                'is_done': i % 3 == 0, 'created_at': 1580000000 + i * 60,
+                                                'finished_at': None, 'distance': 5000, 'frequency': 60})
+    return json.dumps({'message': 'Success!', 'data': payload}).encode('utf-8')
+
+
+@click.command('bench-compression')
+@click.option('--items', type=int, default=2000, help='Number of items in the synthetic payload.')
+@click.option('--repeat', type=int, default=50, help='Compressions timed per level.')
+def bench_compression_command(items, repeat):
+    """Print compressed size and CPU time of each encoding and level."""
+    data = make_payload(items)
+    click.echo('Payload: %d bytes' % len(data))
+    click.echo('%-6s %5s %10s %7s %10s' % ('enc', 'level', 'bytes', 'ratio', 'ms/op'))
+    levels = [('gzip', level) for level in [1, 3, 5, 6, 9]]
+    if brotli is not None:
+        levels += [('br', level) for level in [1, 4, 6, 9, 11]]
+    for encoding, level in levels:
+        start = time.perf_counter()
+        for _ in range(repeat):
+            compressed = compress(data, encoding, level)
+        elapsed = (time.perf_counter() - start) / repeat
+        click.echo('%-6s %5d %10d %7.3f %10.3f' % (encoding, level, len(compressed),
+                                                  len(compressed) / len(data), elapsed * 1000))
+    if brotli is None:
+        click.echo('brotli is not installed, only gzip was measured.')
+
+
+def init_app(app):
+    app.after_request(compress_response)
+    app.cli.add_command(bench_compression_command)
@@ -0,0 +1,8 @@
+-- Creates the database of the default single-shard setup. Run it once per
+-- MySQL server and database (mysql < flaskr/database.sql), then create the
+-- tables with `flask init-db`.
+CREATE DATABASE IF NOT EXISTS notive;
+ALTER DATABASE
+    notive
+    CHARACTER SET = utf8mb4
+    COLLATE = utf8mb4_unicode_ci;
@@ -1,32 +1,326 @@
-from sqlalchemy import create_engine, MetaData
+import bisect
+import functools
+import hashlib
+import re
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+
+from sqlalchemy import create_engine, event, MetaData, Table, select
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.sql.dml import UpdateBase
 from .env import DB_DATABASE, DB_PORT, DB_HOST, DB_PASSWORD, DB_USERNAME
 import click
-from flask import current_app, g
+from flask import current_app, g, request, abort, has_request_context, has_app_context, jsonify, make_response
 from flask.cli import with_appcontext
 
+# Lists and items are sharded by user. DB_SHARDS maps shard names to database
+# URLs; users are placed on the consistent hash ring of the shard names unless
+# the UserShard directory table says otherwise (e.g. after a move, see
+# reshard.py). The directory and the User table live on DB_DIRECTORY_SHARD.
+#
+# Ids must stay unique across shards for users to move without remapping, so
+# MySQL shards are configured with disjoint auto_increment_offset values and
+# auto_increment_increment set to the number of shards. SQLite stand-ins (e.g.
+# for tests) have no such setting; a move stops when an id it copies is
+# already used on the target.
+DEFAULT_SHARD = 'default'
+RING_REPLICAS = 64  # points per shard on the hash ring
+
+# Table DDL of a shard per SQL dialect, see init_db.
+SCHEMAS = {'mysql': 'schema.sql', 'sqlite': 'schema_sqlite.sql'}
+
+_engines = {}
+_engines_lock = threading.Lock()
+_rings = {}
+
+WRITE_STATEMENT = re.compile(r'\s*(INSERT|UPDATE|DELETE|REPLACE)\b', re.IGNORECASE)
+
+
+def get_database_url():
+    return 'mysql://' + DB_USERNAME + ':' + DB_PASSWORD + '@' + DB_HOST + ':' + str(DB_PORT) + '/' + DB_DATABASE
+
+
+def get_shards():
+    return current_app.config.get('DB_SHARDS') or {DEFAULT_SHARD: get_database_url()}
+
+
+def get_directory_shard():
+    shards = get_shards()
+    return current_app.config.get('DB_DIRECTORY_SHARD') or (
+        DEFAULT_SHARD if DEFAULT_SHARD in shards else sorted(shards)[0])
+
+
+def hash_key(key):
+    return int(hashlib.md5(key.encode('utf-8')).hexdigest()[:16], 16)
+
+
+class ShardRing:
+    def __init__(self, shards, replicas=RING_REPLICAS):
+        self.points = sorted((hash_key('%s#%d' % (shard, i)), shard)
+                             for shard in shards for i in range(replicas))
+        self.keys = [point for point, shard in self.points]
+
+    def get_shard(self, user_id):
+        index = bisect.bisect(self.keys, hash_key(str(user_id))) % len(self.keys)
+        return self.points[index][1]
+
+
+def get_ring():
+    shards = tuple(sorted(get_shards()))
+    if shards not in _rings:
+        _rings[shards] = ShardRing(shards)
+    return _rings[shards]
+
+
+def get_engine(shard):
+    # Engines (and so their connection pools) are shared by all requests.
+    url = get_shards()[shard]
+    with _engines_lock:
+        if url not in _engines:
+            _engines[url] = create_engine(url, convert_unicode=True, pool_recycle=3600)
+            event.listen(_engines[url], 'before_execute', begin_on_write)
+            if _engines[url].dialect.name == 'sqlite':
+                event.listen(_engines[url], 'connect', enable_foreign_keys)
+        return _engines[url]
+
+
+def enable_foreign_keys(dbapi_con, connection_record):
+    # SQLite only enforces the foreign keys (and their cascades) when asked.
+    dbapi_con.execute('PRAGMA foreign_keys = ON')
+
+
+def get_shard_db(shard):
+    if 'dbs' not in g:
+        g.dbs = {}
+    if shard not in g.dbs:
+        engine = get_engine(shard)
+        g.dbs[shard] = {'con': engine.connect(), 'engine': engine, 'metadata': MetaData(bind=engine)}
+    return g.dbs[shard]
+
+
+def get_directory_entry(user_id):
+    db = get_shard_db(get_directory_shard())
+    user_shard = Table('UserShard', db['metadata'], autoload=True)
+    return db['con'].execute(user_shard.select(user_shard.c.user_id == user_id)).first()
+
+
+def get_user_shard(user_id, check_moving=True):
+    shards = get_shards()
+    if len(shards) == 1:
+        return next(iter(shards))
+
+    if 'user_shards' not in g:
+        g.user_shards = {}
+    if user_id not in g.user_shards:
+        entry = get_directory_entry(user_id)
+        if entry is not None:
+            g.user_shards[user_id] = (entry['shard'], bool(entry['is_moving']))
+        else:
+            g.user_shards[user_id] = (get_ring().get_shard(user_id), False)
+
+    shard, is_moving = g.user_shards[user_id]
+    # Writes of a user being moved are refused for the short final step of
+    # the move, reads keep being served from the source shard.
+    if check_moving and is_moving and has_request_context() and request.method not in ('GET', 'HEAD'):
+        abort(503)
+    return shard
+
+
+def get_db(user_id=None):
+    """Return the connection to the shard of user_id, or to the directory shard."""
+    if user_id is None:
+        return get_shard_db(get_directory_shard())
+    shard = get_user_shard(user_id)
+    if in_unit_of_work():
+        # Checked against the fences of the shard before commit.
+        g.unit_users.setdefault(shard, set()).add(user_id)
+    return get_shard_db(shard)
+
 
-def get_db():
-    if 'engine' not in g:
-        g.engine = create_engine('mysql://'+DB_USERNAME+':'+DB_PASSWORD+'@' + DB_HOST + ':' + str(DB_PORT) + '/' +
-                                 DB_DATABASE, convert_unicode=True)
-        g.metadata = MetaData(bind=g.engine)
-        g.con = g.engine.connect()
+def get_fenced_users(con, metadata, user_ids):
+    """Return the users of user_ids that are being moved off this shard.
 
-    return {'con': g.con, 'engine': g.engine, 'metadata': g.metadata}
+    Writers call this in their transaction, right before they commit, and
+    give up if a user is fenced. The read takes a shared lock: a move that
+    fences one of these users waits for the transaction to end, so no write
+    commits on the source after the move started its catch-up copy (InnoDB
+    needs REPEATABLE READ for this, its default; SQLite only has one writer).
+    """
+    user_ids = list(user_ids)
+    if not user_ids:
+        return set()
+    user_fence = Table('UserFence', metadata, autoload=True)
+    rows = con.execute(select([user_fence.c.user_id]).where(user_fence.c.user_id.in_(user_ids))
+                       .with_for_update(read=True))
+    return set(r['user_id'] for r in rows)
+
+
+def abort_if_fenced(con, metadata, user_id):
+    """Refuse with 503 the transaction of a user being moved off this shard."""
+    if get_fenced_users(con, metadata, [user_id]):
+        abort(503)
+
+
+def is_write(statement):
+    # Insert, update and delete constructs; SQLAlchemy 1.3 has no is_dml flag.
+    if isinstance(statement, UpdateBase):
+        return True
+    sql = statement if isinstance(statement, str) else getattr(statement, 'text', None)
+    return sql is not None and WRITE_STATEMENT.match(sql) is not None
+
+
+def begin_on_write(con, statement, multiparams, params):
+    # Inside a unit of work the first write on a request connection opens the
+    # transaction, so read-only requests never start one.
+    if has_app_context() and g.get('unit_of_work') and not con.in_transaction() and is_write(statement):
+        if any(db['con'] is con for db in g.get('dbs', {}).values()):
+            g.transactions.append(con.begin())
+
+
+def in_unit_of_work():
+    return has_app_context() and bool(g.get('unit_of_work'))
+
+
+def after_commit(callback):
+    """Call back once the writes of the current unit of work are committed.
+
+    Outside of a unit of work the writes are already committed and the
+    callback runs right away. It is dropped if the unit of work rolls back.
+    """
+    if in_unit_of_work():
+        g.after_commit.append(callback)
+    else:
+        callback()
+
+
+def end_unit_of_work(commit):
+    """Commit or roll back the unit of work; return False if it was fenced.
+
+    A unit of work writing for a user that is being moved off its shard is
+    rolled back instead of committed.
+    """
+    transactions = g.pop('transactions', [])
+    callbacks = g.pop('after_commit', [])
+    unit_users = g.pop('unit_users', {})
+    g.unit_of_work = False
+    fenced = False
+    try:
+        if commit:
+            for shard, user_ids in unit_users.items():
+                db = g.dbs[shard]
+                if db['con'].in_transaction() and get_fenced_users(db['con'], db['metadata'], user_ids):
+                    fenced = True
+                    break
+        for transaction in transactions:
+            if transaction.is_active:
+                if commit and not fenced:
+                    transaction.commit()
+                else:
+                    transaction.rollback()
+    except SQLAlchemyError:
+        for transaction in transactions:
+            if transaction.is_active:
+                transaction.rollback()
+        raise
+    if commit and not fenced:
+        for callback in callbacks:
+            callback()
+    return not fenced
+
+
+class UnitOfWork:
+    def __init__(self):
+        self.rollback_only = False
+
+    def rollback(self):
+        """Roll the writes back instead of committing them when the unit ends."""
+        self.rollback_only = True
+
+
+@contextmanager
+def _unit_of_work():
+    g.unit_of_work = True
+    g.transactions = []
+    g.after_commit = []
+    g.unit_users = {}
+    unit = UnitOfWork()
+    try:
+        yield unit
+    except BaseException:
+        end_unit_of_work(commit=False)
+        raise
+    if not end_unit_of_work(commit=not unit.rollback_only):
+        abort(503)
+
+
+def unit_of_work(view=None):
+    """Run writes in one transaction, committed once at the end.
+
+    Used as a decorator, the writes of a view are committed when it answers
+    with a success status and rolled back otherwise. Called without a view,
+    it returns a context manager for the same around any block of code:
+
+        with unit_of_work() as unit:
+            ...
+            unit.rollback()  # optional, nothing is committed then
+
+    The writes are rolled back if the block raises, and 503 is raised if the
+    user is being moved meanwhile.
+    """
+    if view is None:
+        return _unit_of_work()
+
+    @functools.wraps(view)
+    def wrapped_view(**kwargs):
+        try:
+            with unit_of_work() as unit:
+                response = current_app.make_response(view(**kwargs))
+                if response.status_code >= 400:
+                    unit.rollback()
+        except SQLAlchemyError as e:
+            error = e.__dict__['orig']
+            print("DB ERROR: " + str(error))
+            msg = {"message": "A server error has been occurred. "
+                              "Please try again later and contact us if the error persists. (Error code: "
+                              + str(error.args[0]) + ")",
+                   "data": str(error)}
+            return make_response(jsonify(msg), 500)
+        return response
+
+    return wrapped_view
 
 
 def close_db(e=None):
-    con = g.pop('con', None)
+    if g.get('unit_of_work'):
+        end_unit_of_work(commit=False)
 
-    if con is not None:
-        con.close()
+    dbs = g.pop('dbs', None)
+
+    if dbs is not None:
+        for db in dbs.values():
+            db['con'].close()
 
 
 def init_db():
-    engine = get_db()['engine']
+    # Every shard gets all tables in the database of its URL, which has to
+    # exist (see database.sql).
+    for shard in get_shards():
+        engine = get_shard_db(shard)['engine']
+        if engine.dialect.name == 'mysql' and engine.dialect.server_version_info < (8, 0):
+            raise click.ClickException('Shard %s: MySQL 8.0 or later is required (see schema.sql).' % shard)
 
-    with current_app.open_resource('schema.sql') as f:
-        engine.execute(f.read().decode('utf8'))
+        with current_app.open_resource(SCHEMAS.get(engine.dialect.name, 'schema.sql')) as f:
+            script = f.read().decode('utf8')
+        if engine.dialect.name == 'sqlite':
+            # The sqlite3 driver runs a single statement per execute().
+            con = engine.raw_connection()
+            try:
+                con.executescript(script)
+            finally:
+                con.close()
+        else:
+            engine.execute(script)
 
 
 @click.command('init-db')
@@ -37,6 +331,42 @@ def init_db_command():
     click.echo('Initialized the database.')
 
 
+@click.command('bench-writes')
+@click.argument('user_id', type=int)
+@click.option('--statements', type=int, default=3, help='Writes per simulated request.')
+@click.option('--repeat', type=int, default=200, help='Simulated requests per mode.')
+@with_appcontext
+def bench_writes_command(user_id, statements, repeat):
+    """Compare write latency of autocommit and of one transaction per request."""
+    db = get_db(user_id)
+    con, metadata = db['con'], db['metadata']
+    list_table = Table('List', metadata, autoload=True)
+    # A scratch list, hidden from every read and removed by the purge worker.
+    l_id = con.execute(list_table.insert(), name='bench-writes', user_id=user_id, created_at=int(time.time()),
+                       deleted_at=int(time.time())).lastrowid
+    update = list_table.update().where(list_table.c.id == l_id)
+
+    def run(transactional):
+        start = time.perf_counter()
+        for i in range(repeat):
+            # The same path as a request: the first write begins the
+            # transaction of the unit of work.
+            with unit_of_work() if transactional else nullcontext():
+                for j in range(statements):
+                    con.execute(update.values(name='bench-writes %d-%d' % (i, j)))
+        return (time.perf_counter() - start) / repeat * 1000
+
+    try:
+        autocommit = run(False)
+        transactional = run(True)
+    finally:
+        con.execute(list_table.delete().where(list_table.c.id == l_id))
+    click.echo('%d writes per request, %d requests' % (statements, repeat))
+    click.echo('autocommit:      %.3f ms/request' % autocommit)
+    click.echo('unit of work:    %.3f ms/request' % transactional)
+
+
 def init_app(app):
     app.teardown_appcontext(close_db)
     app.cli.add_command(init_db_command)
+    app.cli.add_command(bench_writes_command)
@@ -0,0 +1,8 @@
+DB_DATABASE = 'notive'
+DB_PORT = 3306
+DB_HOST = 'localhost'
+DB_PASSWORD = ''
+DB_USERNAME = 'root'
+AUTH_KEY = 'test'
+FSQ_CLIENT_ID = ''
+FSQ_CLIENT_SECRET = ''
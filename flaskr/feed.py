@@ -0,0 +1,359 @@
+import itertools
+import json
+import queue
+import threading
+import time
+from collections import deque
+
+from flask import (
+    Blueprint, current_app, g, request, jsonify, make_response, Response, stream_with_context
+)
+from .util import validate_auth_key
+from .db import close_db, after_commit
+from .auth import login_required
+
+bp = Blueprint('feed', __name__, url_prefix='/feed')
+
+FEED_BACKEND = 'local'  # or a redis:// URL to share events between workers
+FEED_HISTORY_SIZE = 256  # events kept per user to resume from Last-Event-ID
+FEED_HISTORY_TTL = 60 * 60  # seconds the history of a user without new events is kept
+FEED_BUFFER_SIZE = 64  # events queued per connection before it is reset
+FEED_HEARTBEAT = 15  # seconds between two SSE keep-alive comments
+FEED_POLL_TIMEOUT = 30  # maximum seconds a long-poll request waits
+FEED_RECONNECT_DELAY = 1  # seconds between two attempts to reconnect to Redis
+
+RESET = 'reset'
+
+
+class LocalBackend:
+    """Delivers events to the connections of the current process only."""
+
+    def __init__(self):
+        # Ids start from the clock so that they keep growing across restarts.
+        self.ids = itertools.count(int(time.time() * 1000))
+        self.lock = threading.Lock()
+        self.handler = None
+        self.last_id = next(self.ids)
+
+    def start(self, handler, reset):
+        self.handler = handler
+
+    def current_id(self):
+        return self.last_id
+
+    def publish(self, user_id, event):
+        with self.lock:
+            event_id = self.last_id = next(self.ids)
+        self.handler(user_id, event_id, event)
+
+
+class RedisBackend:
+    """Shares events between all workers through Redis pub/sub."""
+
+    channel = 'notive:feed'
+    counter = 'notive:feed:id'
+
+    def __init__(self, url):
+        import redis
+        self.redis = redis.Redis.from_url(url)
+
+    def start(self, handler, reset):
+        pubsub = self.redis.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(self.channel)
+
+        def listen():
+            nonlocal pubsub
+            while True:
+                try:
+                    if pubsub is None:
+                        pubsub = self.redis.pubsub(ignore_subscribe_messages=True)
+                        pubsub.subscribe(self.channel)
+                        # Events published while disconnected are lost, the
+                        # connected clients have to resync.
+                        reset()
+                    for message in pubsub.listen():
+                        try:
+                            data = json.loads(message['data'])
+                        except ValueError as e:
+                            print("FEED ERROR: " + str(e))
+                            continue
+                        handler(data['user_id'], data['id'], data['event'])
+                except Exception as e:
+                    print("FEED ERROR: " + str(e))
+                    try:
+                        pubsub.close()
+                    except Exception:
+                        pass
+                    pubsub = None
+                    time.sleep(FEED_RECONNECT_DELAY)
+
+        threading.Thread(target=listen, name='feed-redis', daemon=True).start()
+
+    def current_id(self):
+        return int(self.redis.get(self.counter) or 0)
+
+    def publish(self, user_id, event):
+        event_id = self.redis.incr(self.counter)
+        self.redis.publish(self.channel, json.dumps({'user_id': user_id, 'id': event_id, 'event': event}))
+
+
+class Subscription:
+    def __init__(self, broker, user_id, buffer_size):
+        self.broker = broker
+        self.user_id = user_id
+        self.queue = queue.Queue(maxsize=buffer_size)
+        self.overflowed = False
+        # Id of the last event of the broker when the subscription started.
+        self.last_id = None
+
+    def push(self, event_id, event):
+        try:
+            self.queue.put_nowait((event_id, event))
+        except queue.Full:
+            # A client that does not keep up is told to resync instead of
+            # letting its buffer grow without bounds.
+            self.overflowed = True
+
+    def get(self, timeout):
+        if self.overflowed:
+            self.overflowed = False
+            while not self.queue.empty():
+                self.queue.get_nowait()
+            return None, {'type': RESET}
+        try:
+            return self.queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def reset(self):
+        # Queued like an event, so that a reader blocked on an empty queue
+        # wakes up; a full queue is reset anyway.
+        self.push(None, {'type': RESET})
+
+    def close(self):
+        self.broker.unsubscribe(self)
+
+
+class Broker:
+    def __init__(self, backend, history_size, buffer_size, history_ttl=FEED_HISTORY_TTL):
+        self.backend = backend
+        self.history_size = history_size
+        self.buffer_size = buffer_size
+        self.history_ttl = history_ttl
+        self.lock = threading.Lock()
+        # Every event after floor was dispatched here and is still in the
+        # history of its user, unless listed in evicted.
+        self.floor = None
+        self.last_id = None
+        self.history = {}
+        self.updated_at = {}
+        self.evicted = {}
+        self.pruned_at = time.time()
+        self.subscribers = {}
+        backend.start(self.dispatch, self.reset)
+        current_id = backend.current_id()
+        with self.lock:
+            self.floor = current_id
+            self.last_id = max(self.last_id or 0, current_id)
+
+    def publish(self, user_id, event):
+        self.backend.publish(user_id, event)
+
+    def dispatch(self, user_id, event_id, event):
+        now = time.time()
+        with self.lock:
+            self.last_id = max(self.last_id or 0, event_id)
+            history = self.history.setdefault(user_id, deque())
+            history.append((event_id, event))
+            self.updated_at[user_id] = now
+            if len(history) > self.history_size:
+                self.evicted[user_id] = history.popleft()[0]
+            if now - self.pruned_at > min(self.history_ttl, 60):
+                self.prune(now)
+            subscribers = list(self.subscribers.get(user_id, ()))
+        for subscription in subscribers:
+            subscription.push(event_id, event)
+
+    def prune(self, now):
+        # Users without recent events are dropped, so that the history does
+        # not keep every user the process has ever seen. Cursors from before
+        # the dropped events cannot be resumed any more.
+        self.pruned_at = now
+        for user_id, updated_at in list(self.updated_at.items()):
+            if updated_at < now - self.history_ttl:
+                self.floor = max(self.floor or 0, self.history.pop(user_id)[-1][0])
+                self.evicted.pop(user_id, None)
+                del self.updated_at[user_id]
+
+    def reset(self):
+        # Events may have been missed: the history cannot be replayed any
+        # more and every connection is told to resync.
+        current_id = self.backend.current_id()
+        with self.lock:
+            self.floor = self.last_id = current_id
+            self.history = {}
+            self.updated_at = {}
+            self.evicted = {}
+            subscribers = [s for user_subscribers in self.subscribers.values() for s in user_subscribers]
+        for subscription in subscribers:
+            subscription.reset()
+
+    def subscribe(self, user_id, last_event_id=None):
+        """Return a subscription and the events missed since last_event_id.
+
+        The missed events are None when they cannot be replayed, because they
+        happened before this process started listening or were already
+        dropped from the history; the client has to resync then.
+        """
+        subscription = Subscription(self, user_id, self.buffer_size)
+        with self.lock:
+            self.subscribers.setdefault(user_id, set()).add(subscription)
+            subscription.last_id = self.last_id
+            if last_event_id is None:
+                return subscription, []
+            if last_event_id < self.floor or last_event_id < self.evicted.get(user_id, 0):
+                return subscription, None
+            return subscription, [e for e in self.history.get(user_id, ()) if e[0] > last_event_id]
+
+    def unsubscribe(self, subscription):
+        with self.lock:
+            subscribers = self.subscribers.get(subscription.user_id)
+            if subscribers is not None:
+                subscribers.discard(subscription)
+                if not subscribers:
+                    del self.subscribers[subscription.user_id]
+
+
+_broker = None
+_broker_lock = threading.Lock()
+
+
+def get_broker():
+    global _broker
+    with _broker_lock:
+        if _broker is None:
+            url = current_app.config.get('FEED_BACKEND', FEED_BACKEND)
+            backend = LocalBackend() if url == 'local' else RedisBackend(url)
+            _broker = Broker(backend,
+                             current_app.config.get('FEED_HISTORY_SIZE', FEED_HISTORY_SIZE),
+                             current_app.config.get('FEED_BUFFER_SIZE', FEED_BUFFER_SIZE),
+                             current_app.config.get('FEED_HISTORY_TTL', FEED_HISTORY_TTL))
+    return _broker
+
+
+def publish(user_id, event_type, data):
+    # The feed is best effort: a failing backend must not fail the write
+    # that has already been done.
+    def send():
+        try:
+            get_broker().publish(user_id, {'type': event_type, 'data': data})
+        except Exception as e:
+            print("FEED ERROR: " + str(e))
+
+    # Events of a unit of work are only sent once its writes are committed.
+    after_commit(send)
+
+
+def get_last_event_id():
+    last_event_id = request.headers.get('Last-Event-ID', request.args.get('last_event_id'))
+    try:
+        return int(last_event_id) if last_event_id is not None else None
+    except ValueError:
+        return None
+
+
+def to_sse(event_id, event):
+    lines = []
+    if event_id is not None:
+        lines.append('id: ' + str(event_id))
+    lines.append('event: ' + event['type'])
+    lines.append('data: ' + json.dumps(event.get('data')))
+    return '\n'.join(lines) + '\n\n'
+
+
+@bp.route('/', methods=['GET'], strict_slashes=False)
+@login_required
+def stream():
+    if not validate_auth_key(request):
+        return Response(status=401)
+    else:
+        heartbeat = current_app.config.get('FEED_HEARTBEAT', FEED_HEARTBEAT)
+        subscription, missed = get_broker().subscribe(g.user['id'], get_last_event_id())
+        # The stream may stay open for hours, it must not hold on to the
+        # database connection used to authenticate the request.
+        close_db()
+
+        def generate():
+            # No query is made while the connection is open, an idle client
+            # only costs a blocked thread and a keep-alive every few seconds.
+            try:
+                if missed is None:
+                    yield to_sse(None, {'type': RESET})
+                else:
+                    for event_id, event in missed:
+                        yield to_sse(event_id, event)
+                while True:
+                    entry = subscription.get(heartbeat)
+                    if entry is None:
+                        yield ': keep-alive\n\n'
+                    else:
+                        yield to_sse(*entry)
+            finally:
+                subscription.close()
+
+        response = Response(stream_with_context(generate()), mimetype='text/event-stream')
+        response.headers['Cache-Control'] = 'no-cache'
+        response.headers['X-Accel-Buffering'] = 'no'
+        return response
+
+
+@bp.route('/poll', methods=['GET'], strict_slashes=False)
+@login_required
+def poll():
+    if not validate_auth_key(request):
+        return Response(status=401)
+    else:
+        try:
+            timeout = min(float(request.args.get('timeout', FEED_POLL_TIMEOUT)),
+                          current_app.config.get('FEED_POLL_TIMEOUT', FEED_POLL_TIMEOUT))
+        except ValueError:
+            return make_response(jsonify({"message": "Invalid parameters."}), 400)
+
+        last_event_id = get_last_event_id()
+        subscription, missed = get_broker().subscribe(g.user['id'], last_event_id)
+        # Like the stream, a waiting poll holds no database connection.
+        close_db()
+        try:
+            events = []
+            reset = missed is None
+            if missed:
+                events.extend(missed)
+            elif not reset:
+                entry = subscription.get(max(timeout, 0))
+                # Whatever arrived together with the first event is returned
+                # in the same response.
+                while entry is not None:
+                    if entry[1]['type'] == RESET:
+                        reset = True
+                        events = []
+                    else:
+                        events.append(entry)
+                    entry = subscription.get(0) if not subscription.queue.empty() else None
+        finally:
+            subscription.close()
+
+        if events:
+            last_event_id = events[-1][0]
+        elif reset:
+            last_event_id = None
+        elif last_event_id is None:
+            # A first poll that got no event still gets a cursor, so that
+            # the events published until the next poll are not lost.
+            last_event_id = subscription.last_id
+        result = {"events": [{"id": event_id, "type": event['type'], "data": event.get('data')}
+                             for event_id, event in events],
+                  "last_event_id": last_event_id,
+                  "reset": reset}
+        msg = {"message": "Success!",
+               "data": result}
+        return make_response(jsonify(msg), 200)
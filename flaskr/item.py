@@ -2,13 +2,13 @@ import time
 from flask import (
     Blueprint, g, request, jsonify, make_response, Response
 )
-from sqlalchemy import Table
+from sqlalchemy import Table, select, union_all
 from sqlalchemy.exc import SQLAlchemyError
-from sqlalchemy.sql import and_
 from .util import validate_auth_key, get_json_from_keys, get_json_from_keys_optional
-from .db import get_db
+from .db import get_db, unit_of_work
 from .auth import login_required
 from .list import get_list
+from . import tiering, feed, stats
 
 bp = Blueprint('item', __name__, url_prefix='/item')
 
@@ -17,7 +17,7 @@ bp = Blueprint('item', __name__, url_prefix='/item')
 @login_required
 def get_all():
     user = g.user
-    db = get_db()
+    db = get_db(g.user['id'])
     con, engine, metadata = db['con'], db['engine'], db['metadata']
 
     result = dict()
@@ -28,7 +28,7 @@ def get_all():
     item.*
     FROM Item as item
     INNER JOIN List as list
-    ON item.list_id = list.id WHERE list.user_id = """ + str(user['id']) + """;
+    ON item.list_id = list.id WHERE list.user_id = """ + str(user['id']) + """ AND list.deleted_at IS NULL;
     """)
 
     for qr in query_res:
@@ -46,7 +46,7 @@ def get_all():
 @bp.route('/<int:list_id>', methods=['GET'], strict_slashes=False)
 @login_required
 def get_list_items(list_id):
-    user_list, status = get_list(list_id)
+    user_list, status, is_cold = get_list(list_id, include_cold=True)
     if user_list is None or status is 404:
         msg = {"message": "List does not exist!"}
         return make_response(jsonify(msg), status)
@@ -54,13 +54,16 @@ def get_list_items(list_id):
         msg = {"message": "List is not yours!"}
         return make_response(jsonify(msg), status)
     else:
-        db = get_db()
+        db = get_db(g.user['id'])
         con, engine, metadata = db['con'], db['engine'], db['metadata']
-        item_table = Table('Item', metadata, autoload=True)
+        list_table, item_table, list_archive, item_archive = tiering.get_tables(metadata)
         result = dict()
         result["items"] = []
         count = 0
-        items = item_table.select(item_table.c.list_id == list_id).execute()
+        # Finished items may have been moved to the cold tier, all the items
+        # of a cold list are there.
+        items = union_all(*[select([table.c[c] for c in tiering.ITEM_COLUMNS]).where(table.c.list_id == list_id)
+                            for table in [item_table, item_archive]]).execute()
 
         for i in items:
             result["items"].append(dict(i))
@@ -75,18 +78,14 @@ def get_list_items(list_id):
 @bp.route('/<int:list_id>/<int:item_id>', methods=['GET'], strict_slashes=False)
 @login_required
 def get_item_only(list_id, item_id):
-    user_item, status = get_item(list_id, item_id)
-    if user_item is None or status is 404:
+    item, status, is_cold = get_item(list_id, item_id, include_cold=True)
+    if item is None or status is 404:
         msg = {"message": "Item does not exist!"}
         return make_response(jsonify(msg), status)
     elif status is 403:
         msg = {"message": "Item is not yours!"}
         return make_response(jsonify(msg), status)
     else:
-        db = get_db()
-        con, engine, metadata = db['con'], db['engine'], db['metadata']
-        item_table = Table('Item', metadata, autoload=True)
-        item = item_table.select(item_table.c.id == item_id).execute().first()
         result = {"item": {"id": item['id'],
                            "name": item['name'],
                            "list_id": list_id,
@@ -102,6 +101,7 @@ def get_item_only(list_id, item_id):
 
 @bp.route('/', methods=['POST'], strict_slashes=False)
 @login_required
+@unit_of_work
 def create():
     if not validate_auth_key(request):
         return Response(status=401)
@@ -123,7 +123,7 @@ def create():
                 msg = {"message": "Please provide a name for the item."}
                 return make_response(jsonify(msg), 400)
 
-            user_list, status = get_list(list_id)
+            user_list, status, is_cold = get_list(list_id, include_cold=True)
             if user_list is None or status is 404:
                 msg = {"message": "List does not exist!"}
                 return make_response(jsonify(msg), status)
@@ -132,14 +132,22 @@ def create():
                 return make_response(jsonify(msg), status)
             else:
                 list_name = user_list['name']
-                db = get_db()
+                db = get_db(g.user['id'])
                 con, engine, metadata = db['con'], db['engine'], db['metadata']
                 item_table = Table('Item', metadata, autoload=True)
                 try:
+                    # Items of an archived list in the cold tier need the list
+                    # hot again, it stays archived until the next archival run.
+                    if is_cold:
+                        tiering.restore_list(con, metadata, list_id)
                     res = con.execute(item_table.insert(), name=name, list_id=list_id, created_at=created_at,
                                       distance=distance, frequency=frequency)
+                    stats.item_created(con, g.user['id'], list_id, created_at)
                     data = {'item_id': res.lastrowid,
                             'created_at': created_at}
+                    feed.publish(g.user['id'], 'item.created', {'list_id': list_id, 'item_id': res.lastrowid,
+                                                                'name': name, 'created_at': created_at,
+                                                                'distance': distance, 'frequency': frequency})
                     msg = {"message": "An item has been successfully added to list named '" + list_name + "'.",
                            "data": data}
                 except SQLAlchemyError as e:
@@ -153,32 +161,33 @@ def create():
                 return make_response(jsonify(msg), 200)
 
 
-def get_item(list_id, item_id, check_user=True):
-    db = get_db()
+def get_item(list_id, item_id, check_user=True, include_cold=False):
+    """Return the item, the status of the lookup and whether the item is cold.
+
+    With include_cold, items moved to the cold tier are found too (see
+    tiering.py); in_cold_list tells whether their list is cold as well.
+    """
+    db = get_db(g.user['id'])
     con, engine, metadata = db['con'], db['engine'], db['metadata']
-    item_table = Table('Item', metadata, autoload=True)
-    list_table = Table('List', metadata, autoload=True)
-    joined_table = item_table.join(list_table, list_table.c.id == item_table.c.list_id)
-    item = joined_table.select(and_(item_table.c.id == item_id, list_table.c.id == list_id)).with_only_columns(
-            [item_table.c.id, item_table.c.name, item_table.c.list_id, item_table.c.is_done,
-             item_table.c.created_at, item_table.c.distance, item_table.c.frequency, item_table.c.finished_at,
-             list_table.c.user_id]).execute().first()
+    item = tiering.find_items(con, metadata, [item_id], list_id, include_cold).get(item_id)
+    is_cold = bool(item and item.pop('is_cold'))
 
     if not item:
         status = 404
-        return item, status
+        return item, status, is_cold
     elif check_user and item['user_id'] != g.user['id']:
         status = 403
-        return item, status
+        return item, status, is_cold
     elif item is not None:
         status = 200
-        return item, status
+        return item, status, is_cold
 
-    return item, 500
+    return item, 500, is_cold
 
 
 @bp.route('/<int:list_id>/<int:item_id>', methods=['PUT'], strict_slashes=False)
 @login_required
+@unit_of_work
 def update(list_id, item_id):
     if not validate_auth_key(request):
         return Response(status=401)
@@ -205,7 +214,7 @@ def update(list_id, item_id):
                 msg = {"message": "Please provide one of the following: name, distance, frequency!"}
                 return make_response(jsonify(msg), 400)
 
-            user_item, status = get_item(list_id, item_id)
+            user_item, status, is_cold = get_item(list_id, item_id, include_cold=True)
             if user_item is None or status is 404:
                 msg = {"message": "Item does not exist!"}
                 return make_response(jsonify(msg), status)
@@ -214,9 +223,9 @@ def update(list_id, item_id):
                 return make_response(jsonify(msg), status)
             else:
                 try:
-                    db = get_db()
+                    db = get_db(g.user['id'])
                     con, engine, metadata = db['con'], db['engine'], db['metadata']
-                    item_table = Table('Item', metadata, autoload=True)
+                    item_table = Table('ItemArchive' if is_cold else 'Item', metadata, autoload=True)
 
                     if name is not None:
                         con.execute(item_table.update().where(item_table.c.id == item_id).values(name=name))
@@ -224,6 +233,11 @@ def update(list_id, item_id):
                         con.execute(item_table.update().where(item_table.c.id == item_id).values(distance=distance))
                     if frequency is not None:
                         con.execute(item_table.update().where(item_table.c.id == item_id).values(frequency=frequency))
+                    changes = {'list_id': list_id, 'item_id': item_id}
+                    for key, value in [('name', name), ('distance', distance), ('frequency', frequency)]:
+                        if value is not None:
+                            changes[key] = value
+                    feed.publish(g.user['id'], 'item.updated', changes)
                 except SQLAlchemyError as e:
                     error = e.__dict__['orig']
                     print("DB ERROR: " + str(error))
@@ -238,11 +252,12 @@ def update(list_id, item_id):
 
 @bp.route('/<int:list_id>/<int:item_id>/check', methods=['PUT'], strict_slashes=False)
 @login_required
+@unit_of_work
 def check(list_id, item_id):
     if not validate_auth_key(request):
         return Response(status=401)
     else:
-        user_item, status = get_item(list_id, item_id)
+        user_item, status, is_cold = get_item(list_id, item_id, include_cold=True)
         if user_item is None or status is 404:
             msg = {"message": "Item does not exist!"}
             return make_response(jsonify(msg), status)
@@ -252,18 +267,30 @@ def check(list_id, item_id):
         else:
             try:
                 is_done = bool(user_item['is_done'])
-                db = get_db()
+                db = get_db(g.user['id'])
                 con, engine, metadata = db['con'], db['engine'], db['metadata']
-                item_table = Table('Item', metadata, autoload=True)
+                # The items of a cold list stay with it in the cold tier.
+                in_cold_list = is_cold and bool(user_item['in_cold_list'])
+                item_table = Table('ItemArchive' if in_cold_list else 'Item', metadata, autoload=True)
 
+                if is_cold and not in_cold_list:
+                    tiering.restore_item(con, metadata, item_id)
+
+                finished_at = None if is_done else int(time.time())
                 if not is_done:
                     con.execute(item_table.update().where(item_table.c.id == item_id)
-                                .values(is_done=1, finished_at=int(time.time())))
+                                .values(is_done=1, finished_at=finished_at))
+                    stats.item_checked(con, g.user['id'], list_id, user_item['created_at'], finished_at)
                     msg = {"message": "Item is marked as complete!"}
                 else:
                     con.execute(item_table.update().where(item_table.c.id == item_id).values(is_done=0,
                                                                                              finished_at=None))
+                    if user_item['finished_at'] is not None:
+                        stats.item_checked(con, g.user['id'], list_id, user_item['created_at'],
+                                           user_item['finished_at'], is_done=False)
                     msg = {"message": "Item is marked as not completed!"}
+                feed.publish(g.user['id'], 'item.updated', {'list_id': list_id, 'item_id': item_id,
+                                                            'is_done': not is_done, 'finished_at': finished_at})
                 return make_response(jsonify(msg), 200)
             except SQLAlchemyError as e:
                 error = e.__dict__['orig']
@@ -277,11 +304,12 @@ def check(list_id, item_id):
 
 @bp.route('/<int:list_id>/<int:item_id>', methods=['DELETE'], strict_slashes=False)
 @login_required
+@unit_of_work
 def delete(list_id, item_id):
     if not validate_auth_key(request):
         return Response(status=401)
     else:
-        user_item, status = get_item(list_id, item_id)
+        user_item, status, is_cold = get_item(list_id, item_id, include_cold=True)
         if user_item is None or status is 404:
             msg = {"message": "Item does not exist!"}
             return make_response(jsonify(msg), status)
@@ -290,10 +318,12 @@ def delete(list_id, item_id):
             return make_response(jsonify(msg), status)
         else:
             try:
-                db = get_db()
+                db = get_db(g.user['id'])
                 con, engine, metadata = db['con'], db['engine'], db['metadata']
-                item_table = Table('Item', metadata, autoload=True)
+                item_table = Table('ItemArchive' if is_cold else 'Item', metadata, autoload=True)
                 con.execute(item_table.delete().where(item_table.c.id == item_id))
+                stats.item_deleted(con, g.user['id'], list_id, bool(user_item['is_done']))
+                feed.publish(g.user['id'], 'item.deleted', {'list_id': list_id, 'item_id': item_id})
 
                 msg = {"message": "Item is deleted successfully!"}
                 return make_response(jsonify(msg), 200)
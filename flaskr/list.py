@@ -3,17 +3,20 @@ import time
 from flask import (
     Blueprint, g, request, jsonify, make_response, Response
 )
-from sqlalchemy import Table
+from sqlalchemy import Table, select, func
 from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.sql import and_
 from .util import validate_auth_key, get_json_from_keys
-from .db import get_db
+from .db import get_db, unit_of_work
 from .auth import login_required
+from . import purge, tiering, feed, stats
 
 bp = Blueprint('list', __name__, url_prefix='/list')
 
 
 @bp.route('/', methods=['GET', 'POST'], strict_slashes=False)
 @login_required
+@unit_of_work
 def index():
     if not validate_auth_key(request):
         return Response(status=401)
@@ -35,11 +38,13 @@ def index():
                 user_id = g.user['id']
                 created_at = int(time.time())
                 try:
-                    db = get_db()
+                    db = get_db(g.user['id'])
                     con, engine, metadata = db['con'], db['engine'], db['metadata']
                     list_table = Table('List', metadata, autoload=True)
 
                     res = con.execute(list_table.insert(), name=name, user_id=user_id, created_at=created_at)
+                    feed.publish(user_id, 'list.created', {'list_id': res.lastrowid, 'name': name,
+                                                           'created_at': created_at})
 
                     result = {'list_id': res.lastrowid,
                               'created_at': created_at}
@@ -56,11 +61,29 @@ def index():
                     return make_response(jsonify(msg), 500)
         else:
             try:
-                db = get_db()
+                db = get_db(g.user['id'])
                 con, engine, metadata = db['con'], db['engine'], db['metadata']
                 list_table = Table('List', metadata, autoload=True)
+                item_table = Table('Item', metadata, autoload=True)
+                item_archive = Table('ItemArchive', metadata, autoload=True)
                 user = g.user
-                lists = list_table.select(list_table.c.user_id == user['id']).execute()
+                # Item counters of all lists are computed in grouped queries
+                # instead of one item request per list on the client side.
+                lists = select([list_table,
+                                func.count(item_table.c.id).label('number_of_items'),
+                                func.sum(item_table.c.is_done).label('number_of_done_items')]) \
+                    .select_from(list_table.outerjoin(item_table, item_table.c.list_id == list_table.c.id)) \
+                    .where(and_(list_table.c.user_id == user['id'], list_table.c.deleted_at.is_(None))) \
+                    .group_by(list_table.c.id).execute()
+                # Finished items of hot lists may have been moved to the cold
+                # tier, they still count.
+                cold_counts = select([item_archive.c.list_id,
+                                      func.count(item_archive.c.id).label('number_of_items'),
+                                      func.sum(item_archive.c.is_done).label('number_of_done_items')]) \
+                    .select_from(item_archive.join(list_table, list_table.c.id == item_archive.c.list_id)) \
+                    .where(and_(list_table.c.user_id == user['id'], list_table.c.deleted_at.is_(None))) \
+                    .group_by(item_archive.c.list_id).execute()
+                cold_counts = dict((c['list_id'], c) for c in cold_counts)
             except SQLAlchemyError as e:
                 error = e.__dict__['orig']
                 print("DB ERROR: " + str(error))
@@ -73,7 +96,12 @@ def index():
             result["lists"] = []
             count = 0
             for l in lists:
-                result["lists"].append(dict(l))
+                user_list = dict(l)
+                user_list['number_of_done_items'] = int(user_list['number_of_done_items'] or 0)
+                if l['id'] in cold_counts:
+                    user_list['number_of_items'] += cold_counts[l['id']]['number_of_items']
+                    user_list['number_of_done_items'] += int(cold_counts[l['id']]['number_of_done_items'] or 0)
+                result["lists"].append(user_list)
                 count += 1
             result["number_of_lists"] = count
 
@@ -82,23 +110,60 @@ def index():
             return make_response(jsonify(msg), 200)
 
 
-def get_list(l_id, check_user=True):
-    db = get_db()
+@bp.route('/archived', methods=['GET'], strict_slashes=False)
+@login_required
+def get_archived():
+    if not validate_auth_key(request):
+        return Response(status=401)
+    else:
+        try:
+            db = get_db(g.user['id'])
+            con, engine, metadata = db['con'], db['engine'], db['metadata']
+            list_archive = Table('ListArchive', metadata, autoload=True)
+            lists = list_archive.select(list_archive.c.user_id == g.user['id']).execute()
+        except SQLAlchemyError as e:
+            error = e.__dict__['orig']
+            print("DB ERROR: " + str(error))
+            msg = {"message": "A server error has been occurred. "
+                              "Please try again later and contact us if the error persists. (Error code: "
+                              + str(error.args[0]) + ")",
+                   "data": str(error)}
+            return make_response(jsonify(msg), 500)
+        result = dict()
+        result["lists"] = []
+        count = 0
+        for l in lists:
+            result["lists"].append(dict(l))
+            count += 1
+        result["number_of_lists"] = count
+
+        msg = {"message": "Success!",
+               "data": result}
+        return make_response(jsonify(msg), 200)
+
+
+def get_list(l_id, check_user=True, include_cold=False):
+    """Return the list, the status of the lookup and whether the list is cold.
+
+    With include_cold, archived lists moved to the cold tier are found too
+    (see tiering.py).
+    """
+    db = get_db(g.user['id'])
     con, engine, metadata = db['con'], db['engine'], db['metadata']
-    list_table = Table('List', metadata, autoload=True)
-    user_list = list_table.select(list_table.c.id == l_id).execute().first()
+    user_list = tiering.find_lists(con, metadata, [l_id], include_cold).get(l_id)
+    is_cold = bool(user_list and user_list.pop('is_cold'))
 
     if not user_list:
         status = 404
-        return user_list, status
+        return user_list, status, is_cold
     elif check_user and user_list['user_id'] != g.user['id']:
         status = 403
-        return user_list, status
+        return user_list, status, is_cold
     elif user_list is not None:
         status = 200
-        return user_list, status
+        return user_list, status, is_cold
 
-    return user_list, 500
+    return user_list, 500, is_cold
 
 
 @bp.route('/<int:l_id>', methods=['GET'], strict_slashes=False)
@@ -107,7 +172,7 @@ def get_list_with_id(l_id):
     if not validate_auth_key(request):
         return Response(status=401)
     else:
-        user_list, status = get_list(l_id)
+        user_list, status, is_cold = get_list(l_id, include_cold=True)
         if user_list is None or status is 404:
             msg = {"message": "List does not exist!"}
             return make_response(jsonify(msg), status)
@@ -121,11 +186,12 @@ def get_list_with_id(l_id):
 
 @bp.route('/<int:l_id>', methods=['PUT'], strict_slashes=False)
 @login_required
+@unit_of_work
 def update(l_id):
     if not validate_auth_key(request):
         return Response(status=401)
     else:
-        user_list, status = get_list(l_id)
+        user_list, status, is_cold = get_list(l_id, include_cold=True)
         if user_list is None or status is 404:
             msg = {"message": "List does not exist!"}
             return make_response(jsonify(msg), status)
@@ -146,10 +212,11 @@ def update(l_id):
                     msg = {"message": "Please provide a name!"}
                     return make_response(jsonify(msg), 400)
                 try:
-                    db = get_db()
+                    db = get_db(g.user['id'])
                     con, engine, metadata = db['con'], db['engine'], db['metadata']
-                    list_table = Table('List', metadata, autoload=True)
+                    list_table = Table('ListArchive' if is_cold else 'List', metadata, autoload=True)
                     con.execute(list_table.update().where(list_table.c.id == l_id).values(name=name))
+                    feed.publish(g.user['id'], 'list.updated', {'list_id': l_id, 'name': name})
 
                     msg = {"message": "Success! List name is updated."}
                     return make_response(jsonify(msg), 200)
@@ -165,11 +232,12 @@ def update(l_id):
 
 @bp.route('/<int:l_id>', methods=['DELETE'], strict_slashes=False)
 @login_required
+@unit_of_work
 def delete(l_id):
     if not validate_auth_key(request):
         return Response(status=401)
     else:
-        user_list, status = get_list(l_id)
+        user_list, status, is_cold = get_list(l_id, include_cold=True)
         if user_list is None or status is 404:
             msg = {"message": "List does not exist!"}
             return make_response(jsonify(msg), status)
@@ -178,14 +246,21 @@ def delete(l_id):
             return make_response(jsonify(msg), status)
         else:
             try:
-                db = get_db()
+                db = get_db(g.user['id'])
                 con, engine, metadata = db['con'], db['engine'], db['metadata']
 
-                item_table = Table('Item', metadata, autoload=True)
-                con.execute(item_table.delete().where(item_table.c.list_id == l_id))
+                # A cold list row comes back to List so that the purge worker
+                # finds it; its archived items are purged from ItemArchive.
+                if is_cold:
+                    tiering.restore_list(con, metadata, l_id, with_items=False)
 
+                # The list is only marked here, its items are deleted in chunks
+                # by the purge worker so that the request does not wait for it.
                 list_table = Table('List', metadata, autoload=True)
-                con.execute(list_table.delete().where(list_table.c.id == l_id))
+                con.execute(list_table.update().where(list_table.c.id == l_id).values(deleted_at=int(time.time())))
+                stats.list_deleted(con, metadata, l_id)
+                purge.notify()
+                feed.publish(g.user['id'], 'list.deleted', {'list_id': l_id})
 
                 msg = {"message": "List is deleted successfully."}
                 return make_response(jsonify(msg), 200)
@@ -201,11 +276,12 @@ def delete(l_id):
 
 @bp.route('/<int:l_id>/mute', methods=['PUT'], strict_slashes=False)
 @login_required
+@unit_of_work
 def mute(l_id):
     if not validate_auth_key(request):
         return Response(status=401)
     else:
-        user_list, status = get_list(l_id)
+        user_list, status, is_cold = get_list(l_id, include_cold=True)
         if user_list is None or status is 404:
             msg = {"message": "List does not exist!"}
             return make_response(jsonify(msg), status)
@@ -215,9 +291,9 @@ def mute(l_id):
         else:
             try:
                 is_muted = bool(user_list['is_muted'])
-                db = get_db()
+                db = get_db(g.user['id'])
                 con, engine, metadata = db['con'], db['engine'], db['metadata']
-                list_table = Table('List', metadata, autoload=True)
+                list_table = Table('ListArchive' if is_cold else 'List', metadata, autoload=True)
 
                 if not is_muted:
                     con.execute(list_table.update().where(list_table.c.id == l_id)
@@ -226,6 +302,7 @@ def mute(l_id):
                 else:
                     con.execute(list_table.update().where(list_table.c.id == l_id).values(is_muted=0))
                     msg = {"message": "List is unmuted."}
+                feed.publish(g.user['id'], 'list.updated', {'list_id': l_id, 'is_muted': not is_muted})
                 return make_response(jsonify(msg), 200)
             except SQLAlchemyError as e:
                 error = e.__dict__['orig']
@@ -239,11 +316,12 @@ def mute(l_id):
 
 @bp.route('/<int:l_id>/archive', methods=['PUT'], strict_slashes=False)
 @login_required
+@unit_of_work
 def archive(l_id):
     if not validate_auth_key(request):
         return Response(status=401)
     else:
-        user_list, status = get_list(l_id)
+        user_list, status, is_cold = get_list(l_id, include_cold=True)
         if user_list is None or status is 404:
             msg = {"message": "List does not exist!"}
             return make_response(jsonify(msg), status)
@@ -253,10 +331,12 @@ def archive(l_id):
         else:
             try:
                 is_archived = bool(user_list['is_archived'])
-                db = get_db()
+                db = get_db(g.user['id'])
                 con, engine, metadata = db['con'], db['engine'], db['metadata']
                 list_table = Table('List', metadata, autoload=True)
 
+                if is_cold:
+                    tiering.restore_list(con, metadata, l_id)
                 if not is_archived:
                     con.execute(list_table.update().where(list_table.c.id == l_id)
                                 .values(is_archived=1))
@@ -264,6 +344,7 @@ def archive(l_id):
                 else:
                     con.execute(list_table.update().where(list_table.c.id == l_id).values(is_archived=0))
                     msg = {"message": "List is active."}
+                feed.publish(g.user['id'], 'list.updated', {'list_id': l_id, 'is_archived': not is_archived})
                 return make_response(jsonify(msg), 200)
             except SQLAlchemyError as e:
                 error = e.__dict__['orig']
@@ -0,0 +1,383 @@
+import json
+import time
+
+import click
+from flask import (
+    Blueprint, current_app, g, request, jsonify, make_response, Response
+)
+from flask.cli import with_appcontext
+from sqlalchemy import Table, select
+from sqlalchemy.exc import SQLAlchemyError, IntegrityError
+from sqlalchemy.sql import and_
+from .util import validate_auth_key, get_json_from_keys
+from .db import get_db, get_shards, get_shard_db, abort_if_fenced
+from .auth import login_required
+from . import feed, purge, stats, tiering
+
+bp = Blueprint('ops', __name__, url_prefix='/ops')
+
+# Replays a batch of operations queued by a client while it was offline:
+#
+#   {"ops": [{"op_id": "a1", "type": "list.create", "temp_id": "l1", "name": "Groceries"},
+#            {"op_id": "a2", "type": "item.create", "list_id": "l1", "name": "Milk"},
+#            {"op_id": "a3", "type": "item.check", "item_id": 42}]}
+#
+# list_id and item_id are either real ids or the temp_id of an earlier create
+# in the same batch. Ownership of every referenced list and item is resolved
+# up front in two queries, the batch is applied in one transaction, and the
+# result of each op is stored under its op_id, so that a retried batch
+# returns the stored results instead of applying the ops twice.
+#
+# Stored results are kept for APPLIED_OP_RETENTION (see prune-ops); a batch
+# retried after that is applied again, so it must exceed the time clients keep
+# unacknowledged ops queued.
+MAX_OPS = 500
+MAX_OP_ID_LENGTH = 64
+APPLIED_OP_RETENTION = 30 * 24 * 60 * 60  # seconds
+APPLIED_OP_PRUNE_BATCH_SIZE = 1000  # stored results deleted per statement
+
+OP_TYPES = ['list.create', 'list.update', 'list.mute', 'list.delete',
+            'item.create', 'item.update', 'item.check', 'item.delete']
+
+# Types of the optional op fields, and the longest name of a list and an item
+# (see schema.sql). An op the database would reject is refused on its own
+# instead of failing the whole batch, which its client would retry forever.
+FIELD_TYPES = {'name': str, 'distance': int, 'frequency': int, 'is_done': bool, 'is_muted': bool}
+MAX_NAME_LENGTH = {'list': 100, 'item': 150}
+MAX_INT = 2 ** 31 - 1
+
+
+def is_valid_op(op):
+    return isinstance(op, dict) and op.get('type') in OP_TYPES \
+        and isinstance(op.get('op_id'), str) and 0 < len(op['op_id']) <= MAX_OP_ID_LENGTH
+
+
+def has_valid_fields(op):
+    for key, field_type in FIELD_TYPES.items():
+        value = op.get(key)
+        if value is None:
+            continue
+        if not isinstance(value, field_type) or field_type is int and isinstance(value, bool):
+            return False
+        if field_type is str and not 0 < len(value) <= MAX_NAME_LENGTH[op['type'].split('.')[0]]:
+            return False
+        if field_type is int and not 0 <= value <= MAX_INT:
+            return False
+    return True
+
+
+def get_real_ids(ops, key, temp_ids):
+    ids = set()
+    for op in ops:
+        ref = op.get(key)
+        if isinstance(ref, str):
+            ref = temp_ids.get(ref)
+        if isinstance(ref, int) and not isinstance(ref, bool):
+            ids.add(ref)
+    return ids
+
+
+def get_replayed_temp_ids(ops, results):
+    # Creates applied by an earlier try still resolve their temp_id, so ops
+    # added to the queue since then can refer to them.
+    temp_ids = {'list': {}, 'item': {}}
+    for op in ops:
+        stored = results.get(op['op_id'])
+        if stored is not None and stored['status'] == 200 and op['type'] in ['list.create', 'item.create']:
+            kind = op['type'].split('.')[0]
+            temp_ids[kind][op.get('temp_id')] = stored[kind + '_id']
+    return temp_ids
+
+
+def load_state(con, metadata, user_id, ops, temp_ids):
+    # Like the HTTP handlers, lists and items are found in either tier (see
+    # tiering.py).
+    items = tiering.find_items(con, metadata, get_real_ids(ops, 'item_id', temp_ids['item']))
+    list_ids = get_real_ids(ops, 'list_id', temp_ids['list']) | set(i['list_id'] for i in items.values())
+    lists = tiering.find_lists(con, metadata, list_ids)
+
+    return {'user_id': user_id, 'lists': lists, 'items': items, 'temp_ids': temp_ids,
+            'events': [], 'list_deleted': False}
+
+
+def resolve(state, kind, ref):
+    if isinstance(ref, str):
+        ref = state['temp_ids'][kind].get(ref)
+    elif not isinstance(ref, int) or isinstance(ref, bool):
+        return None, 400
+    row = state[kind + 's'].get(ref)
+    if row is None or row.get('deleted_at') is not None or row.get('deleted'):
+        return None, 404
+    if kind == 'item':
+        user_list = state['lists'].get(row['list_id'])
+        if user_list is None or user_list['deleted_at'] is not None:
+            return None, 404
+    if row['user_id'] != state['user_id']:
+        return None, 403
+    return row, 200
+
+
+def result(status, message, **data):
+    data.update({'status': status, 'message': message})
+    return data
+
+
+def apply_list_op(con, tables, state, op):
+    list_table, item_table, list_archive, item_archive = tables
+    user_id = state['user_id']
+    if not has_valid_fields(op):
+        return result(400, "Invalid parameters.")
+
+    if op['type'] == 'list.create':
+        name = op.get('name')
+        if not name or not isinstance(op.get('temp_id'), str):
+            return result(400, "Invalid parameters.")
+        created_at = int(time.time())
+        res = con.execute(list_table.insert(), name=name, user_id=user_id, created_at=created_at)
+        l_id = res.lastrowid
+        state['lists'][l_id] = {'id': l_id, 'name': name, 'user_id': user_id, 'is_muted': 0, 'deleted_at': None,
+                                'is_cold': False}
+        state['temp_ids']['list'][op['temp_id']] = l_id
+        state['events'].append(('list.created', {'list_id': l_id, 'name': name, 'created_at': created_at}))
+        return result(200, "New list is created successfully!", list_id=l_id, created_at=created_at)
+
+    user_list, status = resolve(state, 'list', op.get('list_id'))
+    if status != 200:
+        return result(status, "List does not exist!" if status == 404 else
+                      "List is not yours!" if status == 403 else "Invalid parameters.")
+    l_id = user_list['id']
+    # Cold lists are updated in place, like in list.update and list.mute.
+    target = list_archive if user_list['is_cold'] else list_table
+
+    if op['type'] == 'list.update':
+        name = op.get('name')
+        if name is None:
+            return result(400, "Please provide a name!")
+        con.execute(target.update().where(target.c.id == l_id).values(name=name))
+        user_list['name'] = name
+        state['events'].append(('list.updated', {'list_id': l_id, 'name': name}))
+        return result(200, "Success! List name is updated.", list_id=l_id)
+    elif op['type'] == 'list.mute':
+        is_muted = bool(op.get('is_muted', not user_list['is_muted']))
+        con.execute(target.update().where(target.c.id == l_id).values(is_muted=int(is_muted)))
+        user_list['is_muted'] = int(is_muted)
+        state['events'].append(('list.updated', {'list_id': l_id, 'is_muted': is_muted}))
+        return result(200, "List is muted." if is_muted else "List is unmuted.", list_id=l_id)
+    else:
+        # A cold list row comes back to List so that the purge worker finds
+        # it, its items are purged from either tier.
+        if user_list['is_cold']:
+            tiering.restore_list(con, list_table.metadata, l_id, with_items=False)
+            user_list['is_cold'] = False
+        deleted_at = int(time.time())
+        con.execute(list_table.update().where(list_table.c.id == l_id).values(deleted_at=deleted_at))
+        stats.list_deleted(con, list_table.metadata, l_id)
+        user_list['deleted_at'] = deleted_at
+        state['list_deleted'] = True
+        state['events'].append(('list.deleted', {'list_id': l_id}))
+        return result(200, "List is deleted successfully.", list_id=l_id)
+
+
+def apply_item_op(con, tables, state, op):
+    list_table, item_table, list_archive, item_archive = tables
+    user_id = state['user_id']
+    if not has_valid_fields(op):
+        return result(400, "Invalid parameters.")
+
+    if op['type'] == 'item.create':
+        user_list, status = resolve(state, 'list', op.get('list_id'))
+        if status != 200:
+            return result(status, "List does not exist!" if status == 404 else
+                          "List is not yours!" if status == 403 else "Invalid parameters.")
+        name = op.get('name')
+        if name is None or not isinstance(op.get('temp_id'), str):
+            return result(400, "Invalid parameters.")
+        # Items of a cold list need the list hot again, like in item.create.
+        if user_list['is_cold']:
+            tiering.restore_list(con, list_table.metadata, user_list['id'])
+            user_list['is_cold'] = False
+            for user_item in state['items'].values():
+                if user_item['list_id'] == user_list['id']:
+                    user_item.update({'is_cold': False, 'in_cold_list': False})
+        values = {'name': name,
+                  'list_id': user_list['id'],
+                  'created_at': int(time.time()),
+                  'distance': op.get('distance') or 5000,
+                  'frequency': op.get('frequency') or 60}
+        res = con.execute(item_table.insert(), **values)
+        item_id = res.lastrowid
+        stats.item_created(con, user_id, user_list['id'], values['created_at'])
+        state['items'][item_id] = dict(values, id=item_id, user_id=user_id, is_done=0, finished_at=None,
+                                       is_cold=False, in_cold_list=False)
+        state['temp_ids']['item'][op['temp_id']] = item_id
+        state['events'].append(('item.created', dict(values, item_id=item_id)))
+        return result(200, "An item has been successfully added to list named '" + user_list['name'] + "'.",
+                      item_id=item_id, created_at=values['created_at'])
+
+    user_item, status = resolve(state, 'item', op.get('item_id'))
+    if status != 200:
+        return result(status, "Item does not exist!" if status == 404 else
+                      "Item is not yours!" if status == 403 else "Invalid parameters.")
+    item_id, list_id = user_item['id'], user_item['list_id']
+    # Cold items are updated and deleted in place, like in item.update and
+    # item.delete.
+    target = item_archive if user_item['is_cold'] else item_table
+
+    if op['type'] == 'item.update':
+        values = {}
+        for key in ['name', 'distance', 'frequency']:
+            if op.get(key) is not None:
+                values[key] = op[key]
+        if not values:
+            return result(400, "Please provide one of the following: name, distance, frequency!")
+        con.execute(target.update().where(target.c.id == item_id).values(**values))
+        user_item.update(values)
+        state['events'].append(('item.updated', dict(values, list_id=list_id, item_id=item_id)))
+        return result(200, "Success! Item is updated.", item_id=item_id)
+    elif op['type'] == 'item.check':
+        is_done = bool(op.get('is_done', not user_item['is_done']))
+        if is_done != bool(user_item['is_done']):
+            # The items of a cold list stay with it in the cold tier, other
+            # cold items come back to the hot tier, like in item.check.
+            if user_item['is_cold'] and not user_item['in_cold_list']:
+                tiering.restore_item(con, list_table.metadata, item_id)
+                user_item['is_cold'] = False
+            target = item_archive if user_item['is_cold'] else item_table
+            finished_at = int(time.time()) if is_done else None
+            con.execute(target.update().where(target.c.id == item_id)
+                        .values(is_done=int(is_done), finished_at=finished_at))
+            if is_done:
+                stats.item_checked(con, user_id, list_id, user_item['created_at'], finished_at)
+            elif user_item['finished_at'] is not None:
+                stats.item_checked(con, user_id, list_id, user_item['created_at'], user_item['finished_at'],
+                                   is_done=False)
+            user_item.update({'is_done': int(is_done), 'finished_at': finished_at})
+            state['events'].append(('item.updated', {'list_id': list_id, 'item_id': item_id,
+                                                     'is_done': is_done, 'finished_at': finished_at}))
+        return result(200, "Item is marked as complete!" if is_done else "Item is marked as not completed!",
+                      item_id=item_id)
+    else:
+        con.execute(target.delete().where(target.c.id == item_id))
+        stats.item_deleted(con, user_id, list_id, bool(user_item['is_done']))
+        user_item['deleted'] = True
+        state['events'].append(('item.deleted', {'list_id': list_id, 'item_id': item_id}))
+        return result(200, "Item is deleted successfully!", item_id=item_id)
+
+
+@bp.route('/', methods=['POST'], strict_slashes=False)
+@login_required
+def replay():
+    if not validate_auth_key(request):
+        return Response(status=401)
+    else:
+        json_data = get_json_from_keys(request, ['ops'])
+        if json_data is False:
+            return make_response(jsonify(
+                {"message": "Request body must be JSON."}), 400)
+        elif json_data is None:
+            return make_response(jsonify({"message": "Invalid parameters."}), 400)
+
+        ops = json_data['ops']
+        if not isinstance(ops, list) or not 0 < len(ops) <= MAX_OPS or not all(is_valid_op(op) for op in ops):
+            msg = {"message": "Please provide between 1 and " + str(MAX_OPS) + " operations, "
+                              "each with an op_id and a known type."}
+            return make_response(jsonify(msg), 400)
+
+        user_id = g.user['id']
+        try:
+            db = get_db(user_id)
+            con, engine, metadata = db['con'], db['engine'], db['metadata']
+            tables = tiering.get_tables(metadata)
+            applied_op = Table('AppliedOp', metadata, autoload=True)
+
+            with con.begin():
+                results = {}
+                for row in con.execute(select([applied_op.c.op_id, applied_op.c.result])
+                                       .where(and_(applied_op.c.user_id == user_id,
+                                                   applied_op.c.op_id.in_(set(op['op_id'] for op in ops))))):
+                    results[row['op_id']] = json.loads(row['result'])
+                replayed = set(results)
+
+                state = load_state(con, metadata, user_id, [op for op in ops if op['op_id'] not in replayed],
+                                   get_replayed_temp_ids(ops, results))
+                applied = []
+                for op in ops:
+                    if op['op_id'] in results:
+                        continue
+                    if op['type'].startswith('list.'):
+                        results[op['op_id']] = apply_list_op(con, tables, state, op)
+                    else:
+                        results[op['op_id']] = apply_item_op(con, tables, state, op)
+                    applied.append({'user_id': user_id,
+                                    'op_id': op['op_id'],
+                                    'result': json.dumps(results[op['op_id']]),
+                                    'created_at': int(time.time())})
+                if applied:
+                    con.execute(applied_op.insert(), applied)
+                abort_if_fenced(con, metadata, user_id)
+        except IntegrityError:
+            # The same ops are being applied by a concurrent retry.
+            msg = {"message": "These operations are already being applied, please retry."}
+            return make_response(jsonify(msg), 409)
+        except SQLAlchemyError as e:
+            error = e.__dict__['orig']
+            print("DB ERROR: " + str(error))
+            msg = {"message": "A server error has been occurred. "
+                              "Please try again later and contact us if the error persists. (Error code: "
+                              + str(error.args[0]) + ")",
+                   "data": str(error)}
+            return make_response(jsonify(msg), 500)
+
+        for event_type, data in state['events']:
+            feed.publish(user_id, event_type, data)
+        if state['list_deleted']:
+            purge.notify()
+
+        ids = {'lists': state['temp_ids']['list'], 'items': state['temp_ids']['item']}
+        data = {'results': [dict(results[op['op_id']], op_id=op['op_id'], replayed=op['op_id'] in replayed)
+                            for op in ops],
+                'ids': ids}
+        msg = {"message": "Success!",
+               "data": data}
+        return make_response(jsonify(msg), 200)
+
+
+def prune_applied_ops(retention=None, batch_size=None):
+    retention = retention if retention is not None else \
+        current_app.config.get('APPLIED_OP_RETENTION', APPLIED_OP_RETENTION)
+    batch_size = batch_size or current_app.config.get('APPLIED_OP_PRUNE_BATCH_SIZE', APPLIED_OP_PRUNE_BATCH_SIZE)
+
+    count = 0
+    created_before = int(time.time()) - retention
+    for shard in get_shards():
+        db = get_shard_db(shard)
+        con, engine, metadata = db['con'], db['engine'], db['metadata']
+        applied_op = Table('AppliedOp', metadata, autoload=True)
+        # Bounded chunks, each one a short statement of its own, like the
+        # purge of deleted lists.
+        while True:
+            ids = [r['id'] for r in con.execute(select([applied_op.c.id])
+                                                .where(applied_op.c.created_at < created_before)
+                                                .limit(batch_size))]
+            if ids:
+                con.execute(applied_op.delete().where(applied_op.c.id.in_(ids)))
+                count += len(ids)
+            if len(ids) < batch_size:
+                break
+    return count
+
+
+@click.command('prune-ops')
+@click.option('--retention', type=int, default=None,
+              help='Keep results of ops applied less than RETENTION seconds ago (default: APPLIED_OP_RETENTION).')
+@click.option('--batch-size', type=int, default=None,
+              help='Number of stored results deleted per statement.')
+@with_appcontext
+def prune_ops_command(retention, batch_size):
+    """Delete the stored results of offline ops applied long ago."""
+    count = prune_applied_ops(retention, batch_size)
+    click.echo('Deleted %d stored op results.' % count)
+
+
+def init_app(app):
+    app.cli.add_command(prune_ops_command)
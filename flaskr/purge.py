@@ -0,0 +1,236 @@
+import threading
+import time
+import uuid
+
+import click
+from flask import (
+    Blueprint, current_app, request, jsonify, make_response, Response
+)
+from flask.cli import with_appcontext
+from sqlalchemy import Table, select, func
+from sqlalchemy.exc import SQLAlchemyError, IntegrityError
+from sqlalchemy.sql import and_, or_
+from .util import validate_auth_key
+from .db import get_shards, get_shard_db, after_commit
+
+bp = Blueprint('purge', __name__, url_prefix='/purge')
+
+PURGE_CHUNK_SIZE = 1000  # items deleted per statement
+PURGE_PAUSE = 0.05  # seconds to wait between two chunks
+PURGE_INTERVAL = 60  # seconds between two scans for lists left over by a restart
+PURGE_LEASE = 60  # seconds a claim on a list is held without progress
+
+# Items of a deleted list may live in both tiers, see tiering.py.
+ITEM_TABLES = ['Item', 'ItemArchive']
+
+# Every process serving the app runs a purge worker, and all of them scan
+# every shard. A list is purged by the worker that claims it in PurgeClaim;
+# the claim is renewed after each chunk and taken over once it expired, when
+# its worker stopped halfway.
+
+_workers = {}
+_lock = threading.Lock()
+
+
+def new_stats():
+    return {'running': False,
+            'current_list_id': None,
+            'lists_purged': 0,
+            'items_purged': 0,
+            'last_run_at': None,
+            'last_error': None}
+
+
+class Worker:
+    """The purge worker of an app in the current process."""
+
+    def __init__(self, app):
+        self.app = app
+        self.wakeup = threading.Event()
+        self.thread = None
+        # Progress, served by GET /purge/status.
+        self.stats = new_stats()
+
+    def is_alive(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def run(self):
+        while True:
+            self.wakeup.wait(self.app.config.get('PURGE_INTERVAL', PURGE_INTERVAL))
+            self.wakeup.clear()
+            with self.app.app_context():
+                try:
+                    purge_pending(self.stats)
+                    self.stats['last_error'] = None
+                except SQLAlchemyError as e:
+                    print("PURGE ERROR: " + str(e))
+                    self.stats['last_error'] = str(e)
+
+
+def get_worker(app):
+    with _lock:
+        if app not in _workers:
+            _workers[app] = Worker(app)
+        return _workers[app]
+
+
+def claim_list(con, metadata, l_id, owner, lease):
+    """Claim the purge of a list for owner, or renew its claim; return whether it holds it."""
+    purge_claim = Table('PurgeClaim', metadata, autoload=True)
+    now = int(time.time())
+    res = con.execute(purge_claim.update()
+                      .where(and_(purge_claim.c.list_id == l_id,
+                                  or_(purge_claim.c.owner == owner, purge_claim.c.claimed_until < now)))
+                      .values(owner=owner, claimed_until=now + lease))
+    if res.rowcount:
+        return True
+    try:
+        con.execute(purge_claim.insert(), list_id=l_id, owner=owner, claimed_until=now + lease)
+    except IntegrityError:
+        return False
+    return True
+
+
+def purge_list(con, metadata, list_table, l_id, chunk_size, pause, stats, owner, lease):
+    """Purge a deleted list unless another worker claimed it; return whether it was purged."""
+    if not claim_list(con, metadata, l_id, owner, lease):
+        return False
+    purge_claim = Table('PurgeClaim', metadata, autoload=True)
+    if not con.execute(select([list_table.c.id]).where(and_(list_table.c.id == l_id,
+                                                            list_table.c.deleted_at.isnot(None)))).first():
+        # Purged by another worker since the scan.
+        con.execute(purge_claim.delete().where(and_(purge_claim.c.list_id == l_id, purge_claim.c.owner == owner)))
+        return False
+    # Items are deleted in bounded chunks, each one a short statement of its
+    # own, so that the purge never holds locks on a large part of the table.
+    stats['current_list_id'] = l_id
+    try:
+        for name in ITEM_TABLES:
+            item_table = Table(name, metadata, autoload=True)
+            while True:
+                ids = [i['id'] for i in con.execute(select([item_table.c.id]).where(item_table.c.list_id == l_id)
+                                                    .limit(chunk_size))]
+                if ids:
+                    con.execute(item_table.delete().where(item_table.c.id.in_(ids)))
+                    stats['items_purged'] += len(ids)
+                if len(ids) < chunk_size:
+                    break
+                time.sleep(pause)
+                if not claim_list(con, metadata, l_id, owner, lease):
+                    return False
+
+        with con.begin():
+            con.execute(list_table.delete().where(and_(list_table.c.id == l_id, list_table.c.deleted_at.isnot(None))))
+            con.execute(purge_claim.delete().where(and_(purge_claim.c.list_id == l_id,
+                                                        purge_claim.c.owner == owner)))
+    finally:
+        stats['current_list_id'] = None
+    stats['lists_purged'] += 1
+    return True
+
+
+def purge_pending(stats=None):
+    """Purge the deleted lists of all shards; return the number purged here."""
+    stats = stats if stats is not None else new_stats()
+    chunk_size = current_app.config.get('PURGE_CHUNK_SIZE', PURGE_CHUNK_SIZE)
+    pause = current_app.config.get('PURGE_PAUSE', PURGE_PAUSE)
+    lease = current_app.config.get('PURGE_LEASE', PURGE_LEASE)
+    owner = uuid.uuid4().hex
+
+    count = 0
+    stats['running'] = True
+    try:
+        for shard in get_shards():
+            db = get_shard_db(shard)
+            con, engine, metadata = db['con'], db['engine'], db['metadata']
+            list_table = Table('List', metadata, autoload=True)
+            user_fence = Table('UserFence', metadata, autoload=True)
+            # The lists of a user being moved go with the move, the target
+            # shard purges them (see reshard.py).
+            pending = con.execute(select([list_table.c.id])
+                                  .where(and_(list_table.c.deleted_at.isnot(None),
+                                              list_table.c.user_id.notin_(select([user_fence.c.user_id]))))
+                                  .order_by(list_table.c.deleted_at)).fetchall()
+            for l in pending:
+                if purge_list(con, metadata, list_table, l['id'], chunk_size, pause, stats, owner, lease):
+                    count += 1
+    finally:
+        stats['running'] = False
+        stats['last_run_at'] = int(time.time())
+    return count
+
+
+def get_backlog():
+    backlog = {'lists': 0, 'items': 0}
+    for shard in get_shards():
+        db = get_shard_db(shard)
+        con, engine, metadata = db['con'], db['engine'], db['metadata']
+        list_table = Table('List', metadata, autoload=True)
+        backlog['lists'] += con.execute(select([func.count(list_table.c.id)])
+                                        .where(list_table.c.deleted_at.isnot(None))).scalar()
+        # Items of a deleted list may still wait in either tier.
+        for name in ITEM_TABLES:
+            item_table = Table(name, metadata, autoload=True)
+            backlog['items'] += con.execute(select([func.count(item_table.c.id)])
+                                            .select_from(item_table.join(list_table,
+                                                                         list_table.c.id == item_table.c.list_id))
+                                            .where(list_table.c.deleted_at.isnot(None))).scalar()
+    return backlog
+
+
+def wake_up(app):
+    if not app.config.get('PURGE_WORKER', True):
+        return
+    worker = get_worker(app)
+    with _lock:
+        if not worker.is_alive():
+            worker.thread = threading.Thread(target=worker.run, name='list-purge', daemon=True)
+            worker.thread.start()
+    worker.wakeup.set()
+
+
+def notify():
+    """Wake up the purge worker of the app in this process, starting it if needed."""
+    app = current_app._get_current_object()
+    # The worker must see the deletion, so it waits for the commit.
+    after_commit(lambda: wake_up(app))
+
+
+@bp.route('/status', methods=['GET'], strict_slashes=False)
+def status():
+    if not validate_auth_key(request):
+        return Response(status=401)
+    else:
+        try:
+            backlog = get_backlog()
+        except SQLAlchemyError as e:
+            error = e.__dict__['orig']
+            print("DB ERROR: " + str(error))
+            msg = {"message": "A server error has been occurred. "
+                              "Please try again later and contact us if the error persists. (Error code: "
+                              + str(error.args[0]) + ")",
+                   "data": str(error)}
+            return make_response(jsonify(msg), 500)
+
+        purge_worker = get_worker(current_app._get_current_object())
+        worker = dict(purge_worker.stats)
+        worker['alive'] = purge_worker.is_alive()
+        msg = {"message": "Success!",
+               "data": {"backlog": backlog, "worker": worker}}
+        return make_response(jsonify(msg), 200)
+
+
+@click.command('purge-lists')
+@with_appcontext
+def purge_lists_command():
+    """Delete the items and rows of all lists marked as deleted."""
+    stats = new_stats()
+    count = purge_pending(stats)
+    click.echo('Purged %d lists (%d items).' % (count, stats['items_purged']))
+
+
+def init_app(app):
+    # Lists marked as deleted before a restart are purged as soon as the app
+    # serves again, not only after the next deletion.
+    app.before_first_request(lambda: wake_up(app))
+    app.cli.add_command(purge_lists_command)
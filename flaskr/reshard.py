@@ -0,0 +1,186 @@
+import click
+from flask.cli import with_appcontext
+from sqlalchemy import Table, select
+from sqlalchemy.sql import and_, or_, not_
+
+from .db import get_shards, get_shard_db, get_directory_shard, get_directory_entry, get_ring
+
+MOVE_BATCH_SIZE = 500  # rows copied or deleted per transaction
+
+# Rows of these tables keep their ids on the target, other rows and clients
+# refer to them. The rows of the other tables are only found by user and are
+# copied as a whole, under the ids of the target.
+KEEP_IDS = ['List', 'ListArchive', 'Item', 'ItemArchive']
+
+
+def get_user_rows(metadata, user_id):
+    """Return (table, condition) for every table holding rows of user_id.
+
+    Parent tables come first, which is the order rows are copied in; they are
+    deleted in the reverse order.
+    """
+    list_table = Table('List', metadata, autoload=True)
+    list_archive = Table('ListArchive', metadata, autoload=True)
+    item_table = Table('Item', metadata, autoload=True)
+    item_archive = Table('ItemArchive', metadata, autoload=True)
+    per_user = [Table(name, metadata, autoload=True)
+                for name in ['StatsDaily', 'StatsDuration', 'StatsList', 'AppliedOp']]
+
+    list_ids = select([list_table.c.id]).where(list_table.c.user_id == user_id)
+    cold_list_ids = select([list_archive.c.id]).where(list_archive.c.user_id == user_id)
+    return [(list_table, list_table.c.user_id == user_id),
+            (list_archive, list_archive.c.user_id == user_id),
+            (item_table, item_table.c.list_id.in_(list_ids)),
+            (item_archive, or_(item_archive.c.list_id.in_(list_ids), item_archive.c.list_id.in_(cold_list_ids)))] \
+        + [(table, table.c.user_id == user_id) for table in per_user]
+
+
+def iter_batches(con, table, condition, batch_size):
+    last_id = None
+    while True:
+        query = select([table]).where(condition)
+        if last_id is not None:
+            query = query.where(table.c.id > last_id)
+        rows = con.execute(query.order_by(table.c.id).limit(batch_size)).fetchall()
+        if not rows:
+            return
+        yield rows
+        last_id = rows[-1]['id']
+
+
+def copy_user(source, target, user_id, batch_size):
+    # A batch replaces the user's rows with the same ids on the target, so the
+    # copy can be run again to catch up with the changes made since the
+    # previous run. An id used on the target by another user stops the move:
+    # the shards were not set up to keep ids unique (see db.py).
+    count = 0
+    target_conditions = dict((t.name, c) for t, c in get_user_rows(target['metadata'], user_id))
+    for source_table, condition in get_user_rows(source['metadata'], user_id):
+        target_table = Table(source_table.name, target['metadata'], autoload=True)
+        target_condition = target_conditions[source_table.name]
+
+        if source_table.name not in KEEP_IDS:
+            with target['con'].begin():
+                target['con'].execute(target_table.delete().where(target_condition))
+                for rows in iter_batches(source['con'], source_table, condition, batch_size):
+                    target['con'].execute(target_table.insert(),
+                                          [dict((k, v) for k, v in row.items() if k != 'id') for row in rows])
+                    count += len(rows)
+            continue
+
+        for rows in iter_batches(source['con'], source_table, condition, batch_size):
+            ids = [row['id'] for row in rows]
+            with target['con'].begin():
+                taken = [r['id'] for r in target['con'].execute(
+                    select([target_table.c.id]).where(and_(target_table.c.id.in_(ids), not_(target_condition))))]
+                if taken:
+                    raise click.ClickException('%s ids %s of user %d are used by another user on the target shard.'
+                                               % (target_table.name, ', '.join(str(i) for i in taken), user_id))
+                target['con'].execute(target_table.delete().where(and_(target_table.c.id.in_(ids),
+                                                                       target_condition)))
+                target['con'].execute(target_table.insert(), [dict(row) for row in rows])
+            count += len(rows)
+    return count
+
+
+def delete_missing(source, target, user_id, batch_size):
+    # Rows deleted on the source during the copy are deleted on the target.
+    count = 0
+    source_conditions = dict((t.name, c) for t, c in get_user_rows(source['metadata'], user_id))
+    for target_table, condition in reversed(get_user_rows(target['metadata'], user_id)):
+        if target_table.name not in KEEP_IDS:
+            continue
+        source_table = Table(target_table.name, source['metadata'], autoload=True)
+        for rows in iter_batches(target['con'], target_table, condition, batch_size):
+            ids = [row['id'] for row in rows]
+            found = set(r['id'] for r in source['con'].execute(
+                select([source_table.c.id]).where(and_(source_table.c.id.in_(ids),
+                                                       source_conditions[source_table.name]))))
+            missing = [i for i in ids if i not in found]
+            if missing:
+                target['con'].execute(target_table.delete().where(and_(target_table.c.id.in_(missing), condition)))
+                count += len(missing)
+    return count
+
+
+def delete_user(db, user_id, batch_size):
+    count = 0
+    for table, condition in reversed(get_user_rows(db['metadata'], user_id)):
+        while True:
+            ids = [row['id'] for row in db['con'].execute(
+                select([table.c.id]).where(condition).limit(batch_size))]
+            if not ids:
+                break
+            db['con'].execute(table.delete().where(table.c.id.in_(ids)))
+            count += len(ids)
+    return count
+
+
+def set_directory_entry(user_id, shard, is_moving):
+    directory = get_shard_db(get_directory_shard())
+    user_shard = Table('UserShard', directory['metadata'], autoload=True)
+    with directory['con'].begin():
+        directory['con'].execute(user_shard.delete().where(user_shard.c.user_id == user_id))
+        directory['con'].execute(user_shard.insert(), user_id=user_id, shard=shard, is_moving=is_moving)
+
+
+def set_fence(db, user_id, is_fenced):
+    # Inserting the fence waits for the transactions that checked it before
+    # (see get_fenced_users), i.e. for the writes already running.
+    user_fence = Table('UserFence', db['metadata'], autoload=True)
+    with db['con'].begin():
+        db['con'].execute(user_fence.delete().where(user_fence.c.user_id == user_id))
+        if is_fenced:
+            db['con'].execute(user_fence.insert(), user_id=user_id)
+
+
+def move_user(user_id, target_shard, batch_size=MOVE_BATCH_SIZE, echo=click.echo):
+    entry = get_directory_entry(user_id)
+    source_shard = entry['shard'] if entry is not None else get_ring().get_shard(user_id)
+    if source_shard == target_shard:
+        echo('User %d is already on shard %s.' % (user_id, target_shard))
+        return
+
+    source, target = get_shard_db(source_shard), get_shard_db(target_shard)
+
+    # 1. Bulk copy while the user keeps reading and writing on the source.
+    echo('Copied %d rows.' % copy_user(source, target, user_id, batch_size))
+
+    # 2. Refuse new writes, wait for the ones running to commit or give up,
+    #    apply the changes made during the bulk copy, then route the user to
+    #    the target.
+    set_directory_entry(user_id, source_shard, True)
+    try:
+        set_fence(source, user_id, True)
+        copied = copy_user(source, target, user_id, batch_size)
+        deleted = delete_missing(source, target, user_id, batch_size)
+        echo('Caught up %d rows, removed %d rows.' % (copied, deleted))
+        # Left over if the user was moved away from the target before.
+        set_fence(target, user_id, False)
+    except Exception:
+        set_fence(source, user_id, False)
+        set_directory_entry(user_id, source_shard, False)
+        raise
+    set_directory_entry(user_id, target_shard, False)
+
+    # 3. The source copy is no longer read by anyone. Its fence stays, it
+    #    refuses the writes of requests that looked up the shard before the
+    #    move and commit after it.
+    echo('Deleted %d rows from shard %s.' % (delete_user(source, user_id, batch_size), source_shard))
+
+
+@click.command('move-user')
+@click.argument('user_id', type=int)
+@click.argument('shard')
+@click.option('--batch-size', type=int, default=MOVE_BATCH_SIZE, help='Rows copied per transaction.')
+@with_appcontext
+def move_user_command(user_id, shard, batch_size):
+    """Move the lists and items of USER_ID to SHARD while the user stays online."""
+    if shard not in get_shards():
+        raise click.BadParameter('Unknown shard: ' + shard)
+    move_user(user_id, shard, batch_size)
+    click.echo('User %d is now on shard %s.' % (user_id, shard))
+
+
+def init_app(app):
+    app.cli.add_command(move_user_command)
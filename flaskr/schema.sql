@@ -1,10 +1,16 @@
-DROP DATABASE IF EXISTS notive;
-CREATE DATABASE notive;
+-- Tables of one shard, created in the database of the shard's URL by
+-- `flask init-db` (see db.py). The database itself is created once per
+-- server with database.sql.
+--
+-- Requires MySQL 8.0 or later: the cold tier (see tiering.py) keeps the ids
+-- of rows moved out of List and Item, which older versions hand out again
+-- after a restart (their AUTO_INCREMENT counter restarts at MAX(id) + 1).
 ALTER DATABASE
-    notive
     CHARACTER SET = utf8mb4
     COLLATE = utf8mb4_unicode_ci;
-USE notive;
+
+DROP TABLE IF EXISTS `PurgeClaim`, `AppliedOp`, `StatsList`, `StatsDuration`, `StatsDaily`, `ItemArchive`, `ListArchive`,
+	`UserFence`, `UserShard`, `Item`, `List`, `User`;
 
 CREATE TABLE `User` (
 	`id` INT(10) PRIMARY KEY AUTO_INCREMENT,
@@ -23,7 +29,11 @@ CREATE TABLE `List` (
 	`user_id` INT(10) NOT NULL,
 	`created_at` INT(11) NOT NULL,
 	`finished_at` INT(11),
-	FOREIGN KEY (user_id) REFERENCES User(id) on delete cascade on update cascade
+	`deleted_at` INT(11),
+	KEY `List_deleted` (`deleted_at`),
+	KEY `List_user` (`user_id`),
+	FULLTEXT KEY `List_name_ft` (`name`)
+	-- No foreign key to User: users live on the directory shard only, see db.py.
 );
 
 CREATE TABLE `Item` (
@@ -35,9 +45,99 @@ CREATE TABLE `Item` (
 	`finished_at` INT(11),
 	`distance` INT(11) NOT NULL DEFAULT 5000,
 	`frequency` INT(11) NOT NULL DEFAULT 60,
+	KEY `Item_list_done` (`list_id`, `is_done`),
+	KEY `Item_done_finished` (`is_done`, `finished_at`),
+	FULLTEXT KEY `Item_name_ft` (`name`),
 	FOREIGN KEY (list_id) REFERENCES List(id) on delete cascade on update cascade
 );
 
+-- Shard directory, only used on the directory shard. Users without a row are
+-- placed by consistent hashing.
+CREATE TABLE `UserShard` (
+	`user_id` INT(10) PRIMARY KEY,
+	`shard` varchar(50) NOT NULL,
+	`is_moving` BOOLEAN NOT NULL DEFAULT '0'
+);
+
+-- Users being moved off this shard, see reshard.py. Writes of a fenced user
+-- are refused on this shard.
+CREATE TABLE `UserFence` (
+	`user_id` INT(10) PRIMARY KEY
+);
+
+-- Cold tier, see tiering.py. Rows keep their ids from List and Item.
+CREATE TABLE `ListArchive` (
+	`id` INT(10) PRIMARY KEY,
+	`name` varchar(100) NOT NULL,
+	`is_done` BOOLEAN NOT NULL DEFAULT '0',
+	`is_muted` BOOLEAN NOT NULL DEFAULT '0',
+	`is_archived` BOOLEAN NOT NULL DEFAULT '0',
+	`user_id` INT(10) NOT NULL,
+	`created_at` INT(11) NOT NULL,
+	`finished_at` INT(11),
+	`archived_at` INT(11) NOT NULL,
+	KEY `ListArchive_user` (`user_id`)
+);
+
+CREATE TABLE `ItemArchive` (
+	`id` INT(10) PRIMARY KEY,
+	`name` varchar(150) NOT NULL,
+	`list_id` INT(10) NOT NULL,
+	`is_done` BOOLEAN NOT NULL DEFAULT '0',
+	`created_at` INT(11) NOT NULL,
+	`finished_at` INT(11),
+	`distance` INT(11) NOT NULL DEFAULT 5000,
+	`frequency` INT(11) NOT NULL DEFAULT 60,
+	`archived_at` INT(11) NOT NULL,
+	KEY `ItemArchive_list` (`list_id`)
+);
+
+-- Productivity rollups, see stats.py. The id columns only serve reshard.py.
+CREATE TABLE `StatsDaily` (
+	`id` INT(10) PRIMARY KEY AUTO_INCREMENT,
+	`user_id` INT(10) NOT NULL,
+	`day` INT(10) NOT NULL,
+	`created` INT(10) NOT NULL DEFAULT 0,
+	`completed` INT(10) NOT NULL DEFAULT 0,
+	UNIQUE KEY `StatsDaily_user_day` (`user_id`, `day`)
+);
+
+CREATE TABLE `StatsDuration` (
+	`id` INT(10) PRIMARY KEY AUTO_INCREMENT,
+	`user_id` INT(10) NOT NULL,
+	`bucket` TINYINT NOT NULL,
+	`count` INT(10) NOT NULL DEFAULT 0,
+	`seconds` BIGINT NOT NULL DEFAULT 0,
+	UNIQUE KEY `StatsDuration_user_bucket` (`user_id`, `bucket`)
+);
+
+CREATE TABLE `StatsList` (
+	`id` INT(10) PRIMARY KEY AUTO_INCREMENT,
+	`list_id` INT(10) NOT NULL,
+	`user_id` INT(10) NOT NULL,
+	`total` INT(10) NOT NULL DEFAULT 0,
+	`done` INT(10) NOT NULL DEFAULT 0,
+	UNIQUE KEY `StatsList_list` (`list_id`),
+	KEY `StatsList_user` (`user_id`)
+);
+
+-- Results of the operations replayed by POST /ops, see ops.py.
+CREATE TABLE `AppliedOp` (
+	`id` INT(10) PRIMARY KEY AUTO_INCREMENT,
+	`user_id` INT(10) NOT NULL,
+	`op_id` varchar(64) NOT NULL,
+	`result` TEXT NOT NULL,
+	`created_at` INT(11) NOT NULL,
+	UNIQUE KEY `AppliedOp_user_op` (`user_id`, `op_id`),
+	KEY `AppliedOp_created` (`created_at`)
+);
+
+CREATE TABLE `PurgeClaim` (
+	`list_id` INT(10) PRIMARY KEY,
+	`owner` varchar(32) NOT NULL,
+	`claimed_until` INT(11) NOT NULL
+);
+
 -- ALTER TABLE `List` ADD CONSTRAINT `List_fk0` FOREIGN KEY (`user_id`) REFERENCES `User`(`id`);
 
 -- ALTER TABLE `Item` ADD CONSTRAINT `Item_fk0` FOREIGN KEY (`list_id`) REFERENCES `List`(`id`);
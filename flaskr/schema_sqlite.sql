@@ -0,0 +1,131 @@
+-- SQLite version of schema.sql, for local stand-in shards (e.g. DB_SHARDS =
+-- {'a': 'sqlite:////tmp/notive_a.db', 'b': 'sqlite:////tmp/notive_b.db'}).
+-- Keep both files in sync. There is no full-text index, search falls back to
+-- prefix matching on SQLite (see search.py).
+DROP TABLE IF EXISTS `PurgeClaim`;
+DROP TABLE IF EXISTS `AppliedOp`;
+DROP TABLE IF EXISTS `StatsList`;
+DROP TABLE IF EXISTS `StatsDuration`;
+DROP TABLE IF EXISTS `StatsDaily`;
+DROP TABLE IF EXISTS `ItemArchive`;
+DROP TABLE IF EXISTS `ListArchive`;
+DROP TABLE IF EXISTS `UserFence`;
+DROP TABLE IF EXISTS `UserShard`;
+DROP TABLE IF EXISTS `Item`;
+DROP TABLE IF EXISTS `List`;
+DROP TABLE IF EXISTS `User`;
+
+CREATE TABLE `User` (
+	`id` INTEGER PRIMARY KEY AUTOINCREMENT,
+	`email` varchar(100) NOT NULL UNIQUE,
+	`password` varchar(100) NOT NULL,
+	`name` varchar(50) NOT NULL UNIQUE,
+	`created_at` INT(11)
+);
+
+CREATE TABLE `List` (
+	`id` INTEGER PRIMARY KEY AUTOINCREMENT,
+	`name` varchar(100) NOT NULL,
+	`is_done` BOOLEAN NOT NULL DEFAULT '0',
+	`is_muted` BOOLEAN NOT NULL DEFAULT '0',
+	`is_archived` BOOLEAN NOT NULL DEFAULT '0',
+	`user_id` INT(10) NOT NULL,
+	`created_at` INT(11) NOT NULL,
+	`finished_at` INT(11),
+	`deleted_at` INT(11)
+);
+CREATE INDEX `List_deleted` ON `List` (`deleted_at`);
+CREATE INDEX `List_user` ON `List` (`user_id`);
+
+CREATE TABLE `Item` (
+	`id` INTEGER PRIMARY KEY AUTOINCREMENT,
+	`name` varchar(150) NOT NULL,
+	`list_id` INT(10) NOT NULL,
+	`is_done` BOOLEAN NOT NULL DEFAULT '0',
+	`created_at` INT(11) NOT NULL,
+	`finished_at` INT(11),
+	`distance` INT(11) NOT NULL DEFAULT 5000,
+	`frequency` INT(11) NOT NULL DEFAULT 60,
+	FOREIGN KEY (list_id) REFERENCES List(id) on delete cascade on update cascade
+);
+CREATE INDEX `Item_list_done` ON `Item` (`list_id`, `is_done`);
+CREATE INDEX `Item_done_finished` ON `Item` (`is_done`, `finished_at`);
+
+CREATE TABLE `UserShard` (
+	`user_id` INT(10) PRIMARY KEY,
+	`shard` varchar(50) NOT NULL,
+	`is_moving` BOOLEAN NOT NULL DEFAULT '0'
+);
+
+CREATE TABLE `UserFence` (
+	`user_id` INT(10) PRIMARY KEY
+);
+
+CREATE TABLE `ListArchive` (
+	`id` INT(10) PRIMARY KEY,
+	`name` varchar(100) NOT NULL,
+	`is_done` BOOLEAN NOT NULL DEFAULT '0',
+	`is_muted` BOOLEAN NOT NULL DEFAULT '0',
+	`is_archived` BOOLEAN NOT NULL DEFAULT '0',
+	`user_id` INT(10) NOT NULL,
+	`created_at` INT(11) NOT NULL,
+	`finished_at` INT(11),
+	`archived_at` INT(11) NOT NULL
+);
+CREATE INDEX `ListArchive_user` ON `ListArchive` (`user_id`);
+
+CREATE TABLE `ItemArchive` (
+	`id` INT(10) PRIMARY KEY,
+	`name` varchar(150) NOT NULL,
+	`list_id` INT(10) NOT NULL,
+	`is_done` BOOLEAN NOT NULL DEFAULT '0',
+	`created_at` INT(11) NOT NULL,
+	`finished_at` INT(11),
+	`distance` INT(11) NOT NULL DEFAULT 5000,
+	`frequency` INT(11) NOT NULL DEFAULT 60,
+	`archived_at` INT(11) NOT NULL
+);
+CREATE INDEX `ItemArchive_list` ON `ItemArchive` (`list_id`);
+
+CREATE TABLE `StatsDaily` (
+	`id` INTEGER PRIMARY KEY AUTOINCREMENT,
+	`user_id` INT(10) NOT NULL,
+	`day` INT(10) NOT NULL,
+	`created` INT(10) NOT NULL DEFAULT 0,
+	`completed` INT(10) NOT NULL DEFAULT 0,
+	UNIQUE (`user_id`, `day`)
+);
+
+CREATE TABLE `StatsDuration` (
+	`id` INTEGER PRIMARY KEY AUTOINCREMENT,
+	`user_id` INT(10) NOT NULL,
+	`bucket` TINYINT NOT NULL,
+	`count` INT(10) NOT NULL DEFAULT 0,
+	`seconds` BIGINT NOT NULL DEFAULT 0,
+	UNIQUE (`user_id`, `bucket`)
+);
+
+CREATE TABLE `StatsList` (
+	`id` INTEGER PRIMARY KEY AUTOINCREMENT,
+	`list_id` INT(10) NOT NULL UNIQUE,
+	`user_id` INT(10) NOT NULL,
+	`total` INT(10) NOT NULL DEFAULT 0,
+	`done` INT(10) NOT NULL DEFAULT 0
+);
+CREATE INDEX `StatsList_user` ON `StatsList` (`user_id`);
+
+CREATE TABLE `AppliedOp` (
+	`id` INTEGER PRIMARY KEY AUTOINCREMENT,
+	`user_id` INT(10) NOT NULL,
+	`op_id` varchar(64) NOT NULL,
+	`result` TEXT NOT NULL,
+	`created_at` INT(11) NOT NULL,
+	UNIQUE (`user_id`, `op_id`)
+);
+CREATE INDEX `AppliedOp_created` ON `AppliedOp` (`created_at`);
+
+CREATE TABLE `PurgeClaim` (
+	`list_id` INT(10) PRIMARY KEY,
+	`owner` varchar(32) NOT NULL,
+	`claimed_until` INT(11) NOT NULL
+);
@@ -0,0 +1,154 @@
+import re
+
+from flask import (
+    Blueprint, g, request, jsonify, make_response, Response
+)
+from sqlalchemy import text
+from sqlalchemy.exc import SQLAlchemyError
+from .util import validate_auth_key
+from .db import get_db
+from .auth import login_required
+
+bp = Blueprint('search', __name__, url_prefix='/search')
+
+DEFAULT_PER_PAGE = 20
+MAX_PER_PAGE = 100
+
+# Characters with a meaning in MySQL's boolean full-text syntax. They are
+# stripped from user input so that every term is matched literally.
+BOOLEAN_OPERATORS = re.compile(r'[+\-<>()~*"@]+')
+
+# InnoDB does not index words shorter than innodb_ft_min_token_size nor the
+# words of its default stopword list. Requiring such a word would match
+# nothing, so they are left out of the full-text query.
+FT_MIN_TOKEN_SIZE = 3
+FT_STOPWORDS = {'a', 'about', 'an', 'are', 'as', 'at', 'be', 'by', 'com', 'de', 'en', 'for', 'from', 'how',
+                'i', 'in', 'is', 'it', 'la', 'of', 'on', 'or', 'that', 'the', 'this', 'to', 'was', 'what',
+                'when', 'where', 'who', 'will', 'with', 'und', 'www'}
+
+SEARCH_QUERY = text("""
+    SELECT 'list' AS type, list.id AS id, list.id AS list_id, list.name AS name,
+    MATCH(list.name) AGAINST(:terms IN BOOLEAN MODE) AS score
+    FROM List AS list
+    WHERE list.user_id = :user_id AND list.deleted_at IS NULL AND MATCH(list.name) AGAINST(:terms IN BOOLEAN MODE)
+    UNION ALL
+    SELECT 'item' AS type, item.id AS id, item.list_id AS list_id, item.name AS name,
+    MATCH(item.name) AGAINST(:terms IN BOOLEAN MODE) AS score
+    FROM Item AS item
+    INNER JOIN List AS list
+    ON item.list_id = list.id
+    WHERE list.user_id = :user_id AND list.deleted_at IS NULL AND MATCH(item.name) AGAINST(:terms IN BOOLEAN MODE)
+    ORDER BY score DESC, type, id DESC
+    LIMIT :limit OFFSET :offset
+""")
+
+# Used when no word of the query is in the full-text index, e.g. "to do" or
+# the first one or two letters typed. Names starting with the query rank
+# before names having a word that starts with it.
+PREFIX_QUERY = text("""
+    SELECT 'list' AS type, list.id AS id, list.id AS list_id, list.name AS name,
+    CASE WHEN list.name LIKE :prefix ESCAPE '!' THEN 2 ELSE 1 END AS score
+    FROM List AS list
+    WHERE list.user_id = :user_id AND list.deleted_at IS NULL
+    AND (list.name LIKE :prefix ESCAPE '!' OR list.name LIKE :word_prefix ESCAPE '!')
+    UNION ALL
+    SELECT 'item' AS type, item.id AS id, item.list_id AS list_id, item.name AS name,
+    CASE WHEN item.name LIKE :prefix ESCAPE '!' THEN 2 ELSE 1 END AS score
+    FROM Item AS item
+    INNER JOIN List AS list
+    ON item.list_id = list.id
+    WHERE list.user_id = :user_id AND list.deleted_at IS NULL
+    AND (item.name LIKE :prefix ESCAPE '!' OR item.name LIKE :word_prefix ESCAPE '!')
+    ORDER BY score DESC, type, id DESC
+    LIMIT :limit OFFSET :offset
+""")
+LIKE_SPECIAL = re.compile(r'([!%_])')
+
+
+def get_words(q):
+    return BOOLEAN_OPERATORS.sub(' ', q).split()
+
+
+def is_indexed(word):
+    return len(word) >= FT_MIN_TOKEN_SIZE and word.lower() not in FT_STOPWORDS
+
+
+def to_boolean_query(words):
+    # Every indexed word has to be present, and the last one is matched as a
+    # prefix so that partially typed words already find results (type-ahead).
+    # None means that no word can be matched by the full-text index.
+    terms = ['+' + word for word in words[:-1] if is_indexed(word)]
+    if len(words[-1]) >= FT_MIN_TOKEN_SIZE:
+        terms.append('+' + words[-1] + '*')
+    if not terms:
+        return None
+    return ' '.join(terms)
+
+
+def to_like_prefix(words):
+    return LIKE_SPECIAL.sub(r'!\1', ' '.join(words)) + '%'
+
+
+def get_int_arg(name, default, minimum, maximum):
+    try:
+        value = int(request.args.get(name, default))
+    except (TypeError, ValueError):
+        return None
+    if value < minimum:
+        return None
+    return min(value, maximum)
+
+
+@bp.route('/', methods=['GET'], strict_slashes=False)
+@login_required
+def index():
+    if not validate_auth_key(request):
+        return Response(status=401)
+    else:
+        words = get_words(request.args.get('q', ''))
+        if not words:
+            msg = {"message": "Please provide a search query!"}
+            return make_response(jsonify(msg), 400)
+
+        page = get_int_arg('page', 1, 1, 10 ** 6)
+        per_page = get_int_arg('per_page', DEFAULT_PER_PAGE, 1, MAX_PER_PAGE)
+        if page is None or per_page is None:
+            return make_response(jsonify({"message": "Invalid parameters."}), 400)
+
+        try:
+            db = get_db(g.user['id'])
+            con, engine, metadata = db['con'], db['engine'], db['metadata']
+            # One extra row is fetched to find out whether there is a next page.
+            # SQLite stand-in shards have no full-text index.
+            terms = to_boolean_query(words) if con.dialect.name != 'sqlite' else None
+            if terms is not None:
+                rows = con.execute(SEARCH_QUERY, terms=terms, user_id=g.user['id'],
+                                   limit=per_page + 1, offset=(page - 1) * per_page).fetchall()
+            else:
+                prefix = to_like_prefix(words)
+                rows = con.execute(PREFIX_QUERY, prefix=prefix, word_prefix='% ' + prefix, user_id=g.user['id'],
+                                   limit=per_page + 1, offset=(page - 1) * per_page).fetchall()
+        except SQLAlchemyError as e:
+            error = e.__dict__['orig']
+            print("DB ERROR: " + str(error))
+            msg = {"message": "A server error has been occurred. "
+                              "Please try again later and contact us if the error persists. (Error code: "
+                              + str(error.args[0]) + ")",
+                   "data": str(error)}
+            return make_response(jsonify(msg), 500)
+
+        results = []
+        for r in rows[:per_page]:
+            results.append({"type": r['type'],
+                            "id": r['id'],
+                            "list_id": r['list_id'],
+                            "name": r['name'],
+                            "score": float(r['score'])})
+
+        result = {"results": results,
+                  "page": page,
+                  "per_page": per_page,
+                  "has_more": len(rows) > per_page}
+        msg = {"message": "Success!",
+               "data": result}
+        return make_response(jsonify(msg), 200)
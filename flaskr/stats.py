@@ -0,0 +1,323 @@
+import time
+
+import click
+import numpy as np
+from flask import (
+    Blueprint, g, request, jsonify, make_response, Response
+)
+from flask.cli import with_appcontext
+from sqlalchemy import Table, select, text, union
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.sql import and_
+from .util import validate_auth_key
+from .db import get_db, get_shards, get_shard_db, get_fenced_users
+from .auth import login_required
+from . import tiering
+
+bp = Blueprint('stats', __name__, url_prefix='/stats')
+
+# Productivity stats are served from rollup tables that the item handlers
+# keep up to date, so a request reads a bounded number of rows whatever the
+# size of the user's history:
+#   StatsDaily     items created and completed per user and day
+#   StatsDuration  histogram of time-to-complete per user, in log2 buckets
+#   StatsList      number of items and of done items per list
+# StatsDaily and StatsDuration record past activity: they keep counting
+# items that were deleted since, so they cannot be rebuilt from the items
+# that are left (see backfill_user).
+DAY = 24 * 60 * 60
+DEFAULT_DAYS = 28
+MAX_DAYS = 366
+BACKFILL_CHUNK_SIZE = 10000
+
+UPSERT_DAILY = text("""
+    INSERT INTO StatsDaily (user_id, day, created, completed) VALUES (:user_id, :day, :created, :completed)
+    ON DUPLICATE KEY UPDATE created = created + VALUES(created), completed = completed + VALUES(completed)
+""")
+UPSERT_DURATION = text("""
+    INSERT INTO StatsDuration (user_id, bucket, count, seconds) VALUES (:user_id, :bucket, :count, :seconds)
+    ON DUPLICATE KEY UPDATE count = count + VALUES(count), seconds = seconds + VALUES(seconds)
+""")
+UPSERT_LIST = text("""
+    INSERT INTO StatsList (list_id, user_id, total, done) VALUES (:list_id, :user_id, :total, :done)
+    ON DUPLICATE KEY UPDATE total = total + VALUES(total), done = done + VALUES(done)
+""")
+
+
+def get_bucket(seconds):
+    # Bucket b holds durations in [2^(b-1), 2^b), bucket 0 holds 0 seconds.
+    return int(seconds).bit_length()
+
+
+# The same upserts for SQLite stand-in shards.
+SQLITE_UPSERT_DAILY = text("""
+    INSERT INTO StatsDaily (user_id, day, created, completed) VALUES (:user_id, :day, :created, :completed)
+    ON CONFLICT (user_id, day) DO UPDATE SET created = created + excluded.created,
+    completed = completed + excluded.completed
+""")
+SQLITE_UPSERT_DURATION = text("""
+    INSERT INTO StatsDuration (user_id, bucket, count, seconds) VALUES (:user_id, :bucket, :count, :seconds)
+    ON CONFLICT (user_id, bucket) DO UPDATE SET count = count + excluded.count, seconds = seconds + excluded.seconds
+""")
+SQLITE_UPSERT_LIST = text("""
+    INSERT INTO StatsList (list_id, user_id, total, done) VALUES (:list_id, :user_id, :total, :done)
+    ON CONFLICT (list_id) DO UPDATE SET total = total + excluded.total, done = done + excluded.done
+""")
+
+UPSERTS = {'mysql': (UPSERT_DAILY, UPSERT_DURATION, UPSERT_LIST),
+           'sqlite': (SQLITE_UPSERT_DAILY, SQLITE_UPSERT_DURATION, SQLITE_UPSERT_LIST)}
+
+
+def apply(con, daily=(), durations=(), lists=()):
+    upsert_daily, upsert_duration, upsert_list = UPSERTS.get(con.dialect.name, UPSERTS['mysql'])
+    if daily:
+        con.execute(upsert_daily, list(daily))
+    if durations:
+        con.execute(upsert_duration, list(durations))
+    if lists:
+        con.execute(upsert_list, list(lists))
+
+
+def item_created(con, user_id, list_id, created_at):
+    apply(con,
+          daily=[{'user_id': user_id, 'day': created_at // DAY, 'created': 1, 'completed': 0}],
+          lists=[{'list_id': list_id, 'user_id': user_id, 'total': 1, 'done': 0}])
+
+
+def item_checked(con, user_id, list_id, created_at, finished_at, is_done=True):
+    """Count an item as completed, or no longer completed when is_done is False."""
+    sign = 1 if is_done else -1
+    seconds = max(finished_at - created_at, 0)
+    apply(con,
+          daily=[{'user_id': user_id, 'day': finished_at // DAY, 'created': 0, 'completed': sign}],
+          durations=[{'user_id': user_id, 'bucket': get_bucket(seconds), 'count': sign, 'seconds': sign * seconds}],
+          lists=[{'list_id': list_id, 'user_id': user_id, 'total': 0, 'done': sign}])
+
+
+def item_deleted(con, user_id, list_id, is_done):
+    # Daily counts and durations record past activity and are kept.
+    apply(con, lists=[{'list_id': list_id, 'user_id': user_id, 'total': -1, 'done': -1 if is_done else 0}])
+
+
+def list_deleted(con, metadata, list_id):
+    stats_list = Table('StatsList', metadata, autoload=True)
+    con.execute(stats_list.delete().where(stats_list.c.list_id == list_id))
+
+
+def aggregate(rows):
+    """Turn item rows into rollup rows, one vectorized pass per chunk.
+
+    Every row needs user_id, list_id, is_done, created_at and finished_at.
+    """
+    user_ids = np.array([r['user_id'] for r in rows], dtype=np.int64)
+    list_ids = np.array([r['list_id'] for r in rows], dtype=np.int64)
+    created_at = np.array([r['created_at'] for r in rows], dtype=np.int64)
+    finished_at = np.array([r['finished_at'] if r['finished_at'] is not None else -1 for r in rows],
+                           dtype=np.int64)
+    done = np.array([bool(r['is_done']) for r in rows], dtype=bool) & (finished_at >= 0)
+
+    daily = {}
+    keys, counts = np.unique(np.stack([user_ids, created_at // DAY], axis=1), axis=0, return_counts=True)
+    for (user_id, day), count in zip(keys.tolist(), counts.tolist()):
+        daily[(user_id, day)] = {'user_id': user_id, 'day': day, 'created': count, 'completed': 0}
+    if done.any():
+        keys, counts = np.unique(np.stack([user_ids[done], finished_at[done] // DAY], axis=1), axis=0,
+                                 return_counts=True)
+        for (user_id, day), count in zip(keys.tolist(), counts.tolist()):
+            row = daily.setdefault((user_id, day), {'user_id': user_id, 'day': day, 'created': 0, 'completed': 0})
+            row['completed'] = count
+
+    durations = []
+    if done.any():
+        seconds = np.maximum(finished_at[done] - created_at[done], 0)
+        buckets = np.where(seconds > 0, np.floor(np.log2(np.maximum(seconds, 1))).astype(np.int64) + 1, 0)
+        keys, inverse, counts = np.unique(np.stack([user_ids[done], buckets], axis=1), axis=0,
+                                          return_inverse=True, return_counts=True)
+        sums = np.bincount(inverse.ravel(), weights=seconds, minlength=len(keys))
+        for (user_id, bucket), count, total in zip(keys.tolist(), counts.tolist(), sums.tolist()):
+            durations.append({'user_id': user_id, 'bucket': bucket, 'count': count, 'seconds': int(total)})
+
+    lists = []
+    keys, inverse, counts = np.unique(np.stack([list_ids, user_ids], axis=1), axis=0,
+                                      return_inverse=True, return_counts=True)
+    done_counts = np.bincount(inverse.ravel(), weights=done.astype(np.float64), minlength=len(keys))
+    for (list_id, user_id), count, done_count in zip(keys.tolist(), counts.tolist(), done_counts.tolist()):
+        lists.append({'list_id': list_id, 'user_id': user_id, 'total': count, 'done': int(done_count)})
+
+    return list(daily.values()), durations, lists
+
+
+def items_added(con, rows):
+    """Add a batch of item rows (e.g. an import) to the rollups."""
+    if rows:
+        apply(con, *aggregate(rows))
+
+
+def get_median(durations):
+    # The histogram gives the bucket holding the median; the mean duration
+    # of that bucket is used as the estimate.
+    total = sum(d['count'] for d in durations)
+    if total <= 0:
+        return None
+    seen = 0
+    for d in sorted(durations, key=lambda d: d['bucket']):
+        seen += d['count']
+        if d['count'] > 0 and seen * 2 >= total:
+            return d['seconds'] / d['count']
+    return None
+
+
+@bp.route('/', methods=['GET'], strict_slashes=False)
+@login_required
+def index():
+    if not validate_auth_key(request):
+        return Response(status=401)
+    else:
+        try:
+            days = min(int(request.args.get('days', DEFAULT_DAYS)), MAX_DAYS)
+        except ValueError:
+            days = 0
+        if days < 1:
+            return make_response(jsonify({"message": "Invalid parameters."}), 400)
+
+        user_id = g.user['id']
+        today = int(time.time()) // DAY
+        first_day = today - days + 1
+        try:
+            db = get_db(user_id)
+            con, engine, metadata = db['con'], db['engine'], db['metadata']
+            stats_daily = Table('StatsDaily', metadata, autoload=True)
+            stats_duration = Table('StatsDuration', metadata, autoload=True)
+            stats_list = Table('StatsList', metadata, autoload=True)
+
+            daily_rows = con.execute(select([stats_daily])
+                                     .where(and_(stats_daily.c.user_id == user_id, stats_daily.c.day >= first_day))
+                                     ).fetchall()
+            durations = [dict(d) for d in con.execute(select([stats_duration])
+                                                      .where(stats_duration.c.user_id == user_id))]
+            list_rows = con.execute(select([stats_list]).where(stats_list.c.user_id == user_id)).fetchall()
+        except SQLAlchemyError as e:
+            error = e.__dict__['orig']
+            print("DB ERROR: " + str(error))
+            msg = {"message": "A server error has been occurred. "
+                              "Please try again later and contact us if the error persists. (Error code: "
+                              + str(error.args[0]) + ")",
+                   "data": str(error)}
+            return make_response(jsonify(msg), 500)
+
+        by_day = {}
+        for d in daily_rows:
+            by_day[d['day']] = d
+        daily = []
+        weekly = {}
+        for day in range(first_day, today + 1):
+            created = by_day[day]['created'] if day in by_day else 0
+            completed = by_day[day]['completed'] if day in by_day else 0
+            daily.append({'day': day * DAY, 'created': created, 'completed': completed})
+            # Weeks start on Monday, the epoch (day 0) was a Thursday.
+            week = (day - (day + 3) % 7) * DAY
+            weekly.setdefault(week, {'week': week, 'created': 0, 'completed': 0})
+            weekly[week]['created'] += created
+            weekly[week]['completed'] += completed
+
+        lists = []
+        for l in list_rows:
+            lists.append({'list_id': l['list_id'],
+                          'total': l['total'],
+                          'done': l['done'],
+                          'completion_rate': l['done'] / l['total'] if l['total'] > 0 else None})
+
+        completed = sum(d['count'] for d in durations)
+        seconds = sum(d['seconds'] for d in durations)
+        result = {"daily": daily,
+                  "weekly": sorted(weekly.values(), key=lambda w: w['week']),
+                  "completed": completed,
+                  "mean_time_to_complete": seconds / completed if completed > 0 else None,
+                  "median_time_to_complete": get_median(durations),
+                  "lists": lists}
+        msg = {"message": "Success!",
+               "data": result}
+        return make_response(jsonify(msg), 200)
+
+
+def iter_item_chunks(con, metadata, user_id, chunk_size):
+    list_table = Table('List', metadata, autoload=True)
+    for items_source, lists_source in tiering.get_item_sources(metadata):
+        condition = and_(lists_source.c.id == items_source.c.list_id, lists_source.c.user_id == user_id)
+        if lists_source is list_table:
+            condition = and_(condition, list_table.c.deleted_at.is_(None))
+        last_id = 0
+        while True:
+            rows = con.execute(select([items_source.c.id, items_source.c.list_id, items_source.c.is_done,
+                                       items_source.c.created_at, items_source.c.finished_at,
+                                       lists_source.c.user_id])
+                               .select_from(items_source.join(lists_source, condition))
+                               .where(items_source.c.id > last_id)
+                               .order_by(items_source.c.id).limit(chunk_size)).fetchall()
+            if not rows:
+                break
+            yield rows
+            last_id = rows[-1]['id']
+
+
+def get_user_ids(con, metadata):
+    # Users with items, and users with list rollups left over from deleted
+    # lists.
+    tables = [Table(name, metadata, autoload=True) for name in ['List', 'ListArchive', 'StatsList']]
+    query = union(*[select([table.c.user_id]) for table in tables])
+    return sorted(r['user_id'] for r in con.execute(query))
+
+
+def has_history(con, metadata, user_id):
+    for name in ['StatsDaily', 'StatsDuration']:
+        table = Table(name, metadata, autoload=True)
+        if con.execute(select([table.c.id]).where(table.c.user_id == user_id).limit(1)).first():
+            return True
+    return False
+
+
+def backfill_user(con, metadata, user_id, chunk_size):
+    """Rebuild the list rollups of a user from their items.
+
+    Daily counts and durations are only computed for a user who has none
+    yet (e.g. on the first run), the ones kept by the item handlers also
+    count deleted items and are left as they are.
+    """
+    count = 0
+    with con.begin():
+        # Rollups being moved to another shard go with the move.
+        if get_fenced_users(con, metadata, [user_id]):
+            return 0
+        with_history = not has_history(con, metadata, user_id)
+        # The rows are deleted before the items are read: an item written
+        # meanwhile either is read here or waits for the commit to upsert.
+        stats_list = Table('StatsList', metadata, autoload=True)
+        con.execute(stats_list.delete().where(stats_list.c.user_id == user_id))
+        for rows in iter_item_chunks(con, metadata, user_id, chunk_size):
+            daily, durations, lists = aggregate(rows)
+            if with_history:
+                apply(con, daily, durations, lists)
+            else:
+                apply(con, lists=lists)
+            count += len(rows)
+    return count
+
+
+@click.command('backfill-stats')
+@click.option('--chunk-size', type=int, default=BACKFILL_CHUNK_SIZE, help='Item rows aggregated at once.')
+@with_appcontext
+def backfill_stats_command(chunk_size):
+    """Rebuild the list stats from the existing items."""
+    # One transaction per user, so that the item writes of a user only wait
+    # for the rebuild of that user.
+    count = 0
+    for shard in get_shards():
+        db = get_shard_db(shard)
+        con, engine, metadata = db['con'], db['engine'], db['metadata']
+        for user_id in get_user_ids(con, metadata):
+            count += backfill_user(con, metadata, user_id, chunk_size)
+    click.echo('Aggregated %d items.' % count)
+
+
+def init_app(app):
+    app.cli.add_command(backfill_stats_command)
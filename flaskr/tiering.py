@@ -0,0 +1,214 @@
+import time
+from contextlib import contextmanager
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from sqlalchemy import Table, select, literal
+from sqlalchemy.sql import and_
+
+from .db import get_shards, get_shard_db, get_fenced_users, in_unit_of_work
+
+# Archived lists and items finished longer ago than ARCHIVE_AFTER are moved
+# from List/Item (hot tier) to ListArchive/ItemArchive (cold tier), so that the
+# tables every request reads only hold the data users are working with.
+#
+# Handlers that address a list or an item by id find it in either tier
+# (get_list and get_item with include_cold, find_lists and find_items for
+# batches) and change cold rows in place, except for the changes that need
+# the row hot again. Collection reads only serve hot lists: GET /list and
+# GET /item, cold lists are served by GET /list/archived.
+#
+# Rows moved out keep their ids, which the hot tables must never hand out
+# again: this needs the AUTO_INCREMENT counters of MySQL 8.0, which survive
+# a restart (see schema.sql).
+ARCHIVE_AFTER = 30 * 24 * 60 * 60  # seconds
+ARCHIVE_BATCH_SIZE = 100  # lists or items moved per transaction
+
+LIST_COLUMNS = ['id', 'name', 'is_done', 'is_muted', 'is_archived', 'user_id', 'created_at', 'finished_at']
+ITEM_COLUMNS = ['id', 'name', 'list_id', 'is_done', 'created_at', 'finished_at', 'distance', 'frequency']
+
+
+def get_tables(metadata):
+    return (Table('List', metadata, autoload=True),
+            Table('Item', metadata, autoload=True),
+            Table('ListArchive', metadata, autoload=True),
+            Table('ItemArchive', metadata, autoload=True))
+
+
+def copy_rows(con, source, target, columns, condition, extra=None):
+    extra = extra or {}
+    names = columns + list(extra)
+    values = [source.c[c] for c in columns] + [literal(v).label(k) for k, v in extra.items()]
+    con.execute(target.insert().from_select(names, select(values).where(condition)))
+
+
+def move_rows(con, source, target, columns, condition, extra=None):
+    copy_rows(con, source, target, columns, condition, extra)
+    con.execute(source.delete().where(condition))
+
+
+def select_unfenced(con, metadata, query, user_id_column):
+    # Rows of users being moved off the shard stay where they are until the
+    # move is done (see reshard.py). The fence check also makes a move wait
+    # for the batch to commit.
+    user_fence = Table('UserFence', metadata, autoload=True)
+    rows = con.execute(query.where(user_id_column.notin_(select([user_fence.c.user_id])))).fetchall()
+    fenced = get_fenced_users(con, metadata, set(r['user_id'] for r in rows))
+    return [r['id'] for r in rows if r['user_id'] not in fenced]
+
+
+def archive_lists(con, metadata, batch_size):
+    list_table, item_table, list_archive, item_archive = get_tables(metadata)
+    with con.begin():
+        ids = select_unfenced(con, metadata, select([list_table.c.id, list_table.c.user_id])
+                              .where(and_(list_table.c.is_archived == 1, list_table.c.deleted_at.is_(None)))
+                              .limit(batch_size).with_for_update(), list_table.c.user_id)
+        if ids:
+            now = int(time.time())
+            move_rows(con, item_table, item_archive, ITEM_COLUMNS, item_table.c.list_id.in_(ids),
+                      {'archived_at': now})
+            move_rows(con, list_table, list_archive, LIST_COLUMNS, list_table.c.id.in_(ids),
+                      {'archived_at': now})
+    return len(ids)
+
+
+def archive_items(con, metadata, finished_before, batch_size):
+    list_table, item_table, list_archive, item_archive = get_tables(metadata)
+    with con.begin():
+        ids = select_unfenced(con, metadata, select([item_table.c.id, list_table.c.user_id])
+                              .select_from(item_table.join(list_table, list_table.c.id == item_table.c.list_id))
+                              .where(and_(item_table.c.is_done == 1, item_table.c.finished_at < finished_before))
+                              .limit(batch_size).with_for_update(), list_table.c.user_id)
+        if ids:
+            move_rows(con, item_table, item_archive, ITEM_COLUMNS, item_table.c.id.in_(ids),
+                      {'archived_at': int(time.time())})
+    return len(ids)
+
+
+def run_archival(age=None, batch_size=None):
+    age = age if age is not None else current_app.config.get('ARCHIVE_AFTER', ARCHIVE_AFTER)
+    batch_size = batch_size or current_app.config.get('ARCHIVE_BATCH_SIZE', ARCHIVE_BATCH_SIZE)
+
+    counts = {'lists': 0, 'items': 0}
+    finished_before = int(time.time()) - age
+    for shard in get_shards():
+        db = get_shard_db(shard)
+        con, engine, metadata = db['con'], db['engine'], db['metadata']
+        while True:
+            moved = archive_lists(con, metadata, batch_size)
+            counts['lists'] += moved
+            if moved < batch_size:
+                break
+
+        while True:
+            moved = archive_items(con, metadata, finished_before, batch_size)
+            counts['items'] += moved
+            if moved < batch_size:
+                break
+    return counts
+
+
+def get_item_sources(metadata):
+    """Return the (items, lists) table pairs an item may be found in, hot first.
+
+    Items of a hot list are in Item, or in ItemArchive once finished long
+    ago; the items of a cold list are all in ItemArchive.
+    """
+    list_table, item_table, list_archive, item_archive = get_tables(metadata)
+    return [(item_table, list_table), (item_archive, list_table), (item_archive, list_archive)]
+
+
+def find_lists(con, metadata, list_ids, include_cold=True):
+    """Return the lists of list_ids that are not deleted, by id.
+
+    The rows are dicts with is_cold telling the tier they are in.
+    """
+    list_table, item_table, list_archive, item_archive = get_tables(metadata)
+    lists = {}
+    list_ids = set(list_ids)
+    if list_ids:
+        # Deleted lists wait for the purge worker and are hidden from all reads.
+        rows = con.execute(select([list_table])
+                           .where(and_(list_table.c.id.in_(list_ids), list_table.c.deleted_at.is_(None))))
+        for row in rows:
+            lists[row['id']] = dict(row, is_cold=False)
+    missing = list_ids - set(lists)
+    if include_cold and missing:
+        rows = con.execute(select([list_archive.c[c] for c in LIST_COLUMNS]).where(list_archive.c.id.in_(missing)))
+        for row in rows:
+            lists[row['id']] = dict(row, deleted_at=None, is_cold=True)
+    return lists
+
+
+def find_items(con, metadata, item_ids, list_id=None, include_cold=True):
+    """Return the items of item_ids with the user_id of their list, by id.
+
+    The rows are dicts with is_cold telling the tier they are in, and
+    in_cold_list whether their list is cold too. Items of deleted lists are
+    left out, and those of another list than list_id if given.
+    """
+    list_table = Table('List', metadata, autoload=True)
+    items = {}
+    sources = get_item_sources(metadata)
+    for items_source, lists_source in sources if include_cold else sources[:1]:
+        missing = set(item_ids) - set(items)
+        if not missing:
+            break
+        condition = items_source.c.id.in_(missing)
+        if list_id is not None:
+            condition = and_(condition, lists_source.c.id == list_id)
+        if lists_source is list_table:
+            condition = and_(condition, list_table.c.deleted_at.is_(None))
+        columns = [items_source.c[c] for c in ITEM_COLUMNS] + [lists_source.c.user_id]
+        rows = con.execute(select(columns)
+                           .select_from(items_source.join(lists_source, lists_source.c.id == items_source.c.list_id))
+                           .where(condition))
+        for row in rows:
+            items[row['id']] = dict(row, is_cold=items_source is not sources[0][0],
+                                    in_cold_list=lists_source is not list_table)
+    return items
+
+
+@contextmanager
+def restore_transaction(con):
+    # Inside a unit of work, or a transaction the caller already began, the
+    # restore is part of the caller's writes and is committed or rolled back
+    # with them; begin_on_write opens the unit's transaction if needed.
+    if in_unit_of_work() or con.in_transaction():
+        yield
+    else:
+        with con.begin():
+            yield
+
+
+def restore_list(con, metadata, l_id, with_items=True):
+    """Move a list (and by default its items) back to the hot tier."""
+    list_table, item_table, list_archive, item_archive = get_tables(metadata)
+    with restore_transaction(con):
+        move_rows(con, list_archive, list_table, LIST_COLUMNS, list_archive.c.id == l_id)
+        if with_items:
+            move_rows(con, item_archive, item_table, ITEM_COLUMNS, item_archive.c.list_id == l_id)
+
+
+def restore_item(con, metadata, item_id):
+    """Move an item back to the hot tier."""
+    list_table, item_table, list_archive, item_archive = get_tables(metadata)
+    with restore_transaction(con):
+        move_rows(con, item_archive, item_table, ITEM_COLUMNS, item_archive.c.id == item_id)
+
+
+@click.command('archive-data')
+@click.option('--age', type=int, default=None,
+              help='Archive items finished more than AGE seconds ago (default: ARCHIVE_AFTER).')
+@click.option('--batch-size', type=int, default=None,
+              help='Number of lists or items moved per transaction.')
+@with_appcontext
+def archive_data_command(age, batch_size):
+    """Move archived lists and old finished items to the cold tables."""
+    counts = run_archival(age, batch_size)
+    click.echo('Archived %d lists and %d finished items.' % (counts['lists'], counts['items']))
+
+
+def init_app(app):
+    app.cli.add_command(archive_data_command)
@@ -0,0 +1,54 @@
+import pytest
+from sqlalchemy import Table
+
+from flaskr import create_app
+from flaskr.db import init_db, get_shard_db, get_directory_shard
+from flaskr.util import AUTH_KEY
+
+
+@pytest.fixture
+def app(tmp_path):
+    # Two SQLite stand-ins for the MySQL shards, "a" holds the directory.
+    app = create_app({
+        'TESTING': True,
+        'DB_SHARDS': {'a': 'sqlite:///' + str(tmp_path / 'a.db'),
+                      'b': 'sqlite:///' + str(tmp_path / 'b.db')},
+        'DB_DIRECTORY_SHARD': 'a',
+        # Tests purge deleted lists themselves, see test_purge.py.
+        'PURGE_WORKER': False,
+    })
+
+    with app.app_context():
+        init_db()
+
+    return app
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
+
+
+class AuthActions(object):
+    def __init__(self, app, client):
+        self._app = app
+        self._client = client
+
+    def login(self, user_id):
+        with self._app.app_context():
+            directory = get_shard_db(get_directory_shard())
+            users = Table('User', directory['metadata'], autoload=True)
+            if not directory['con'].execute(users.select(users.c.id == user_id)).first():
+                directory['con'].execute(users.insert(), id=user_id, email='user%d@example.com' % user_id,
+                                         password='x', name='user%d' % user_id, created_at=0)
+        with self._client.session_transaction() as session:
+            session['user_id'] = user_id
+
+    @property
+    def headers(self):
+        return {'Authorization': AUTH_KEY}
+
+
+@pytest.fixture
+def auth(app, client):
+    return AuthActions(app, client)
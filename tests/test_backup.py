@@ -0,0 +1,28 @@
+import json
+
+from sqlalchemy import Table, select
+
+from flaskr.db import get_db
+
+USER_ID = 1
+
+
+def test_export_import(app, client, auth):
+    auth.login(USER_ID)
+    l_id = client.post('/list', json={'name': 'Groceries'}, headers=auth.headers).get_json()['data']['list_id']
+    client.post('/item', json={'name': 'Milk', 'list_id': l_id}, headers=auth.headers)
+
+    records = [json.loads(line) for line in client.get('/export', headers=auth.headers).data.splitlines()]
+    assert [r['type'] for r in records] == ['list', 'item', 'end']
+    assert records[-1] == {'type': 'end', 'lists': 1, 'items': 1}
+
+    # Nothing after the end record is imported.
+    records.append({'type': 'list', 'id': 99, 'name': 'Extra', 'created_at': 100})
+    body = ''.join(json.dumps(r) + '\n' for r in records)
+    response = client.post('/import', data=body, headers=auth.headers)
+    assert response.status_code == 200
+    assert response.get_json()['data'] == {'lists': 1, 'items': 1}
+    with app.app_context():
+        db = get_db(USER_ID)
+        list_table = Table('List', db['metadata'], autoload=True)
+        assert [l['name'] for l in db['con'].execute(select([list_table]))] == ['Groceries', 'Groceries']
@@ -0,0 +1,34 @@
+from flaskr.feed import Broker, LocalBackend, RESET
+
+USER_ID = 1
+
+
+def test_first_poll_gets_a_cursor(client, auth):
+    auth.login(USER_ID)
+    response = client.get('/feed/poll?timeout=0', headers=auth.headers)
+    cursor = response.get_json()['data']['last_event_id']
+    assert cursor is not None
+
+    client.post('/list', json={'name': 'Groceries'}, headers=auth.headers)
+    response = client.get('/feed/poll?timeout=0&last_event_id=%d' % cursor, headers=auth.headers)
+    data = response.get_json()['data']
+    assert [e['type'] for e in data['events']] == ['list.created']
+    assert data['last_event_id'] > cursor
+
+
+def test_history_of_idle_users_is_dropped():
+    broker = Broker(LocalBackend(), history_size=10, buffer_size=10, history_ttl=60)
+    subscription, missed = broker.subscribe(USER_ID)
+    cursor = subscription.last_id
+    broker.publish(USER_ID, {'type': 'list.created'})
+    assert [e[1]['type'] for e in broker.subscribe(USER_ID, cursor)[1]] == ['list.created']
+
+    broker.prune(broker.updated_at[USER_ID] + 61)
+    assert broker.history == {}
+    # The dropped events cannot be resumed, the client has to resync.
+    assert broker.subscribe(USER_ID, cursor)[1] is None
+    assert broker.subscribe(USER_ID, broker.last_id)[1] == []
+
+    broker.reset()
+    assert subscription.get(0)[1] == {'type': 'list.created'}
+    assert subscription.get(0) == (None, {'type': RESET})
@@ -0,0 +1,75 @@
+from sqlalchemy import Table, select
+
+from flaskr import ops, tiering
+from flaskr.db import get_db
+
+USER_ID = 1
+
+
+def archive_all(app):
+    with app.app_context():
+        db = get_db(USER_ID)
+        list_table = Table('List', db['metadata'], autoload=True)
+        db['con'].execute(list_table.update().values(is_archived=1))
+        tiering.run_archival(age=0)
+
+
+def rows(app, name):
+    with app.app_context():
+        db = get_db(USER_ID)
+        table = Table(name, db['metadata'], autoload=True)
+        return db['con'].execute(select([table]).order_by(table.c.id)).fetchall()
+
+
+def test_replay_on_cold_list(app, client, auth):
+    auth.login(USER_ID)
+    response = client.post('/ops', headers=auth.headers, json={'ops': [
+        {'op_id': 'a1', 'type': 'list.create', 'temp_id': 'l1', 'name': 'Groceries'},
+        {'op_id': 'a2', 'type': 'item.create', 'temp_id': 'i1', 'list_id': 'l1', 'name': 'Milk'}]})
+    ids = response.get_json()['data']['ids']
+    l_id, item_id = ids['lists']['l1'], ids['items']['i1']
+    archive_all(app)
+    assert rows(app, 'List') == [] and len(rows(app, 'ItemArchive')) == 1
+
+    response = client.post('/ops', headers=auth.headers, json={'ops': [
+        {'op_id': 'b1', 'type': 'list.update', 'list_id': l_id, 'name': 'Shopping'},
+        {'op_id': 'b2', 'type': 'item.check', 'item_id': item_id}]})
+    assert [r['status'] for r in response.get_json()['data']['results']] == [200, 200]
+    # Both stay cold, the item with its list.
+    assert [(l['id'], l['name']) for l in rows(app, 'ListArchive')] == [(l_id, 'Shopping')]
+    assert [i['is_done'] for i in rows(app, 'ItemArchive')] == [1]
+
+    response = client.post('/ops', headers=auth.headers, json={'ops': [
+        {'op_id': 'c1', 'type': 'item.create', 'temp_id': 'i2', 'list_id': l_id, 'name': 'Eggs'}]})
+    assert response.get_json()['data']['results'][0]['status'] == 200
+    # Adding an item brings the list and its items back to the hot tier.
+    assert rows(app, 'ListArchive') == [] and rows(app, 'ItemArchive') == []
+    assert [i['name'] for i in rows(app, 'Item')] == ['Milk', 'Eggs']
+
+
+def test_prune_applied_ops(app, client, auth):
+    auth.login(USER_ID)
+    client.post('/ops', headers=auth.headers, json={'ops': [
+        {'op_id': 'a1', 'type': 'list.create', 'temp_id': 'l1', 'name': 'Groceries'}]})
+
+    with app.app_context():
+        assert ops.prune_applied_ops() == 0
+        assert ops.prune_applied_ops(retention=-1, batch_size=1) == 1
+    assert rows(app, 'AppliedOp') == []
+
+
+def test_invalid_op_is_refused_alone(app, client, auth):
+    auth.login(USER_ID)
+    response = client.post('/ops', headers=auth.headers, json={'ops': [
+        {'op_id': 'a1', 'type': 'list.create', 'temp_id': 'l1', 'name': 'Groceries'},
+        {'op_id': 'a2', 'type': 'list.create', 'temp_id': 'l2', 'name': {'x': 1}},
+        {'op_id': 'a3', 'type': 'item.create', 'temp_id': 'i1', 'list_id': 'l1', 'name': 'Milk', 'distance': True},
+        {'op_id': 'a4', 'type': 'item.create', 'temp_id': 'i2', 'list_id': 'l1', 'name': 'Milk', 'frequency': '60'},
+        {'op_id': 'a5', 'type': 'list.mute', 'list_id': 'l1', 'is_muted': 'yes'},
+        {'op_id': 'a6', 'type': 'list.update', 'list_id': 'l1', 'name': ''}]})
+    assert response.status_code == 200
+    assert [r['status'] for r in response.get_json()['data']['results']] == [200, 400, 400, 400, 400, 400]
+    assert [l['name'] for l in rows(app, 'List')] == ['Groceries']
+    assert rows(app, 'Item') == []
+    # The refusals are stored too, a retried batch gets the same results.
+    assert len(rows(app, 'AppliedOp')) == 6
@@ -0,0 +1,69 @@
+import time
+
+from sqlalchemy import Table, select
+
+from flaskr import purge, tiering
+from flaskr.db import get_db
+
+USER_ID = 1
+
+
+def count_rows(name):
+    db = get_db(USER_ID)
+    table = Table(name, db['metadata'], autoload=True)
+    return len(db['con'].execute(select([table])).fetchall())
+
+
+def add_deleted_list(client, auth, items=3):
+    l_id = client.post('/list', json={'name': 'Groceries'}, headers=auth.headers).get_json()['data']['list_id']
+    for i in range(items):
+        client.post('/item', json={'name': 'Milk', 'list_id': l_id}, headers=auth.headers)
+    client.delete('/list/%d' % l_id, headers=auth.headers)
+    return l_id
+
+
+def test_purge_pending(app, client, auth):
+    auth.login(USER_ID)
+    l_id = add_deleted_list(client, auth)
+    with app.app_context():
+        # One of the items waits in the cold tier.
+        db = get_db(USER_ID)
+        list_table, item_table, list_archive, item_archive = tiering.get_tables(db['metadata'])
+        tiering.move_rows(db['con'], item_table, item_archive, tiering.ITEM_COLUMNS,
+                          item_table.c.id == select([item_table.c.id]).limit(1).as_scalar(), {'archived_at': 0})
+        assert purge.get_backlog() == {'lists': 1, 'items': 3}
+
+        stats = purge.new_stats()
+        app.config['PURGE_PAUSE'] = 0
+        app.config['PURGE_CHUNK_SIZE'] = 1
+        assert purge.purge_pending(stats) == 1
+        assert (stats['lists_purged'], stats['items_purged']) == (1, 3)
+        assert purge.get_backlog() == {'lists': 0, 'items': 0}
+        assert [count_rows(name) for name in ['List', 'Item', 'ItemArchive', 'PurgeClaim']] == [0, 0, 0, 0]
+        # Nothing is left for a second run.
+        assert purge.purge_pending() == 0
+
+
+def test_claimed_list_is_left_to_its_worker(app, client, auth):
+    auth.login(USER_ID)
+    l_id = add_deleted_list(client, auth, items=1)
+    with app.app_context():
+        db = get_db(USER_ID)
+        assert purge.claim_list(db['con'], db['metadata'], l_id, 'other', 60)
+        assert purge.purge_pending() == 0
+        assert purge.get_backlog() == {'lists': 1, 'items': 1}
+
+        # An expired claim is taken over.
+        purge_claim = Table('PurgeClaim', db['metadata'], autoload=True)
+        db['con'].execute(purge_claim.update().values(claimed_until=int(time.time()) - 1))
+        assert purge.purge_pending() == 1
+        assert purge.get_backlog() == {'lists': 0, 'items': 0}
+
+
+def test_one_worker_per_app(app):
+    other = type(app)(__name__)
+    assert purge.get_worker(app) is purge.get_worker(app)
+    assert purge.get_worker(app) is not purge.get_worker(other)
+    # Workers can be turned off, e.g. for tests.
+    purge.wake_up(app)
+    assert not purge.get_worker(app).is_alive()
@@ -0,0 +1,29 @@
+from flaskr.search import get_words, to_boolean_query, to_like_prefix
+
+
+def test_last_word_is_a_prefix():
+    assert to_boolean_query(get_words('oat milk')) == '+oat +milk*'
+    assert to_boolean_query(get_words('mil')) == '+mil*'
+
+
+def test_short_last_word():
+    # Too short for the index, the other words still have to match.
+    assert to_boolean_query(get_words('milk 2')) == '+milk'
+    assert to_boolean_query(get_words('mi')) is None
+
+
+def test_stopwords_are_not_required():
+    assert to_boolean_query(get_words('milk for the cat')) == '+milk +cat*'
+    assert to_boolean_query(get_words('to do')) is None
+    assert to_boolean_query(get_words('it is on')) is None
+
+
+def test_boolean_operators_are_stripped():
+    assert get_words('+milk -eggs (bread)* "oat" @2 ~x <y>') == ['milk', 'eggs', 'bread', 'oat', '2', 'x', 'y']
+    assert to_boolean_query(get_words('-milk*')) == '+milk*'
+    assert get_words('+-*') == []
+
+
+def test_like_prefix_is_escaped():
+    assert to_like_prefix(['to', 'do']) == 'to do%'
+    assert to_like_prefix(['100%', 'a_b!']) == '100!% a!_b!!%'
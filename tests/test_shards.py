@@ -0,0 +1,124 @@
+import click
+import pytest
+from sqlalchemy import Table, select
+from werkzeug.exceptions import ServiceUnavailable
+
+from flaskr import reshard, stats
+from flaskr.db import get_ring, get_user_shard, get_shard_db, get_db, unit_of_work
+
+
+def users_on(shard, count=1):
+    user_ids = [u for u in range(1, 1000) if get_ring().get_shard(u) == shard]
+    return user_ids[:count]
+
+
+def list_rows(shard, user_id=None):
+    db = get_shard_db(shard)
+    list_table = Table('List', db['metadata'], autoload=True)
+    query = select([list_table]).order_by(list_table.c.id)
+    if user_id is not None:
+        query = query.where(list_table.c.user_id == user_id)
+    return db['con'].execute(query).fetchall()
+
+
+def add_list(shard, user_id, l_id, items=(), name='Groceries'):
+    db = get_shard_db(shard)
+    list_table = Table('List', db['metadata'], autoload=True)
+    item_table = Table('Item', db['metadata'], autoload=True)
+    db['con'].execute(list_table.insert(), id=l_id, name=name, user_id=user_id, created_at=100)
+    for item_id in items:
+        db['con'].execute(item_table.insert(), id=item_id, name='Milk', list_id=l_id, created_at=100)
+        stats.item_created(db['con'], user_id, l_id, 100)
+
+
+def test_routing(app, client, auth):
+    with app.app_context():
+        user_a, = users_on('a')
+        user_b, = users_on('b')
+        # Both shards get users.
+        assert get_user_shard(user_a) == 'a'
+        assert get_user_shard(user_b) == 'b'
+
+    for user_id in [user_a, user_b]:
+        auth.login(user_id)
+        response = client.post('/list', json={'name': 'Groceries'}, headers=auth.headers)
+        assert response.status_code == 200
+
+    with app.app_context():
+        assert [l['user_id'] for l in list_rows('a')] == [user_a]
+        assert [l['user_id'] for l in list_rows('b')] == [user_b]
+
+
+def test_directory_override(app, client, auth):
+    with app.app_context():
+        user_id, = users_on('a')
+        reshard.set_directory_entry(user_id, 'b', False)
+        assert get_user_shard(user_id) == 'b'
+
+    auth.login(user_id)
+    assert client.post('/list', json={'name': 'Groceries'}, headers=auth.headers).status_code == 200
+    with app.app_context():
+        assert list_rows('a') == []
+        assert len(list_rows('b', user_id)) == 1
+
+    with app.app_context():
+        reshard.set_directory_entry(user_id, 'b', True)
+    # Reads are served during a move, writes are refused.
+    assert client.get('/list', headers=auth.headers).status_code == 200
+    assert client.post('/list', json={'name': 'Chores'}, headers=auth.headers).status_code == 503
+
+
+def test_move_user(app, client, auth):
+    with app.app_context():
+        user_id, = users_on('a')
+        other_id, = users_on('b')
+        add_list('a', user_id, 1, items=[10, 11])
+        add_list('a', user_id, 2)
+        # Another user already on the target, with other ids.
+        add_list('b', other_id, 3, items=[12])
+
+        reshard.move_user(user_id, 'b', batch_size=1, echo=lambda message: None)
+
+        assert get_user_shard(user_id) == 'b'
+        assert list_rows('a') == []
+        assert [l['id'] for l in list_rows('b', user_id)] == [1, 2]
+        assert [l['id'] for l in list_rows('b', other_id)] == [3]
+        db = get_shard_db('b')
+        item_table = Table('Item', db['metadata'], autoload=True)
+        stats_list = Table('StatsList', db['metadata'], autoload=True)
+        assert [i['id'] for i in db['con'].execute(select([item_table]).order_by(item_table.c.id))] == [10, 11, 12]
+        totals = dict((s['list_id'], s['total']) for s in db['con'].execute(select([stats_list])))
+        assert totals == {1: 2, 3: 1}
+
+    auth.login(user_id)
+    response = client.get('/list', headers=auth.headers)
+    assert [l['number_of_items'] for l in response.get_json()['data']['lists']] == [2, 0]
+
+
+def test_move_user_id_taken(app):
+    with app.app_context():
+        user_id, = users_on('a')
+        other_id, = users_on('b')
+        add_list('a', user_id, 1, items=[10])
+        add_list('b', other_id, 1, items=[11], name='Chores')
+
+        with pytest.raises(click.ClickException):
+            reshard.move_user(user_id, 'b', echo=lambda message: None)
+
+        # Nothing of the other user is overwritten and the user stays put.
+        assert [(l['user_id'], l['name']) for l in list_rows('b')] == [(other_id, 'Chores')]
+        assert [l['id'] for l in list_rows('a', user_id)] == [1]
+        assert get_user_shard(user_id) == 'a'
+
+
+def test_fenced_write_is_rolled_back(app):
+    with app.test_request_context('/list', method='POST'):
+        user_id, = users_on('a')
+        reshard.set_fence(get_shard_db('a'), user_id, True)
+
+        with pytest.raises(ServiceUnavailable):
+            with unit_of_work():
+                db = get_db(user_id)
+                list_table = Table('List', db['metadata'], autoload=True)
+                db['con'].execute(list_table.insert(), name='Groceries', user_id=user_id, created_at=100)
+        assert list_rows('a') == []
@@ -0,0 +1,67 @@
+from sqlalchemy import Table, select
+
+from flaskr.db import get_db
+
+USER_ID = 1
+ROLLUPS = {'StatsDaily': ['user_id', 'day', 'created', 'completed'],
+           'StatsDuration': ['user_id', 'bucket', 'count', 'seconds'],
+           'StatsList': ['list_id', 'user_id', 'total', 'done']}
+
+
+def get_rollups(app):
+    with app.app_context():
+        db = get_db(USER_ID)
+        rollups = {}
+        for name, columns in ROLLUPS.items():
+            table = Table(name, db['metadata'], autoload=True)
+            rows = db['con'].execute(select([table.c[c] for c in columns]))
+            rollups[name] = sorted(tuple(r) for r in rows)
+        return rollups
+
+
+def clear_rollups(app):
+    with app.app_context():
+        db = get_db(USER_ID)
+        for name in ROLLUPS:
+            table = Table(name, db['metadata'], autoload=True)
+            db['con'].execute(table.delete())
+
+
+def backfill(app):
+    result = app.test_cli_runner().invoke(args=['backfill-stats'])
+    assert result.exit_code == 0, result.output
+
+
+def add_item(client, auth, l_id, name, check=False):
+    item_id = client.post('/item', json={'name': name, 'list_id': l_id},
+                          headers=auth.headers).get_json()['data']['item_id']
+    if check:
+        client.put('/item/%d/%d/check' % (l_id, item_id), headers=auth.headers)
+    return item_id
+
+
+def test_backfill_matches_incremental_rollups(app, client, auth):
+    auth.login(USER_ID)
+    l_id = client.post('/list', json={'name': 'Groceries'}, headers=auth.headers).get_json()['data']['list_id']
+    gone_id = client.post('/list', json={'name': 'Chores'}, headers=auth.headers).get_json()['data']['list_id']
+    add_item(client, auth, l_id, 'Milk', check=True)
+    add_item(client, auth, l_id, 'Eggs')
+    deleted_id = add_item(client, auth, l_id, 'Bread', check=True)
+    client.delete('/item/%d/%d' % (l_id, deleted_id), headers=auth.headers)
+    add_item(client, auth, gone_id, 'Dishes', check=True)
+    client.delete('/list/%d' % gone_id, headers=auth.headers)
+
+    incremental = get_rollups(app)
+    assert incremental['StatsDaily'][0][2:] == (4, 3)
+    assert incremental['StatsList'] == [(l_id, USER_ID, 2, 1)]
+
+    # Past activity survives a backfill, list rollups are rebuilt the same.
+    backfill(app)
+    assert get_rollups(app) == incremental
+
+    # Without any rollups, a backfill computes them from the items left.
+    clear_rollups(app)
+    backfill(app)
+    rebuilt = get_rollups(app)
+    assert rebuilt['StatsDaily'][0][2:] == (2, 1)
+    assert rebuilt['StatsList'] == incremental['StatsList']
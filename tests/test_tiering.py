@@ -0,0 +1,50 @@
+from flask import g
+from sqlalchemy import select
+
+from flaskr import tiering
+from flaskr.db import get_db, unit_of_work
+
+USER_ID = 1
+
+
+def test_restore_is_part_of_unit_of_work(app):
+    with app.test_request_context('/item', method='POST'):
+        db = get_db(USER_ID)
+        con, metadata = db['con'], db['metadata']
+        list_table, item_table, list_archive, item_archive = tiering.get_tables(metadata)
+        con.execute(list_table.insert(), id=1, name='Groceries', user_id=USER_ID, created_at=100, is_archived=1)
+        con.execute(item_table.insert(), id=10, name='Milk', list_id=1, created_at=100)
+        tiering.run_archival(age=0)
+
+        with unit_of_work() as unit:
+            db = get_db(USER_ID)
+            tiering.restore_list(db['con'], db['metadata'], 1)
+            assert len(g.transactions) == 1
+            # The restore is undone with the rest of the request.
+            unit.rollback()
+        assert [l['id'] for l in con.execute(select([list_archive]))] == [1]
+        assert [i['id'] for i in con.execute(select([item_archive]))] == [10]
+        assert con.execute(select([list_table])).fetchall() == []
+
+
+def test_cold_rows_are_served_by_id(app, client, auth):
+    auth.login(USER_ID)
+    l_id = client.post('/list', json={'name': 'Groceries'}, headers=auth.headers).get_json()['data']['list_id']
+    item_id = client.post('/item', json={'name': 'Milk', 'list_id': l_id},
+                          headers=auth.headers).get_json()['data']['item_id']
+    client.put('/list/%d/archive' % l_id, headers=auth.headers)
+    with app.app_context():
+        assert tiering.run_archival(age=0) == {'lists': 1, 'items': 0}
+
+    # Reads by id find the cold rows like the writes do.
+    assert client.get('/list/%d' % l_id, headers=auth.headers).get_json()['data']['name'] == 'Groceries'
+    response = client.get('/item/%d' % l_id, headers=auth.headers)
+    assert [i['id'] for i in response.get_json()['data']['items']] == [item_id]
+    assert client.get('/item/%d/%d' % (l_id, item_id), headers=auth.headers).status_code == 200
+    response = client.put('/item/%d/%d' % (l_id, item_id), json={'name': 'Oat milk'}, headers=auth.headers)
+    assert response.status_code == 200
+    response = client.get('/item/%d/%d' % (l_id, item_id), headers=auth.headers)
+    assert response.get_json()['data']['item']['name'] == 'Oat milk'
+    # Collections only serve hot lists.
+    assert client.get('/list', headers=auth.headers).get_json()['data']['lists'] == []
+    assert client.get('/item/%d/%d' % (l_id + 1, item_id), headers=auth.headers).status_code == 404